@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# Replay a netsplit against the channel roster: 5000 users spread over
+# a few hundred channels QUIT at once and later rejoin under new
+# nicknames. The old {channel: {nick: [modes]}} dictionary, that had to
+# scan every channel for QUIT and NICK, is timed for comparison.
+#
+# Usage: python3 benchmarks/roster_netsplit.py [users] [channels]
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from irc.roster import Roster  # noqa: E402
+
+
+def populate(users, channels, seed=1):
+    """Return [(channel, nickname)] memberships. Every user is in 1 to 5
+    channels."""
+    rnd = random.Random(seed)
+    chans = [f"#channel{n}" for n in range(channels)]
+    ret = []
+    for n in range(users):
+        for channel in rnd.sample(chans, rnd.randint(1, 5)):
+            ret.append((channel, f"User{n}"))
+    return ret
+
+
+def old_replay(memberships, nicks):
+    names = {}
+    for channel, nickname in memberships:
+        names.setdefault(channel, {})[nickname] = [""]
+
+    start = time.perf_counter()
+    for nickname in nicks:  # QUIT
+        for channel in names:
+            if nickname in names[channel]:
+                del names[channel][nickname]
+    quit_t = time.perf_counter() - start
+
+    for channel, nickname in memberships:
+        names[channel][nickname] = [""]
+
+    start = time.perf_counter()
+    for nickname in nicks:  # NICK
+        for channel in names:
+            if nickname in names[channel]:
+                mode = names[channel].pop(nickname)
+                names[channel][nickname + "_"] = mode
+    nick_t = time.perf_counter() - start
+    return quit_t, nick_t
+
+
+def roster_replay(memberships, nicks):
+    roster = Roster()
+    for channel, nickname in memberships:
+        roster.join(channel, nickname)
+
+    start = time.perf_counter()
+    for nickname in nicks:
+        roster.quit(nickname)
+    quit_t = time.perf_counter() - start
+
+    for channel, nickname in memberships:
+        roster.join(channel, nickname)
+
+    start = time.perf_counter()
+    for nickname in nicks:
+        roster.rename(nickname, nickname + "_")
+    nick_t = time.perf_counter() - start
+    return quit_t, nick_t
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    channels = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    memberships = populate(users, channels)
+    nicks = [f"User{n}" for n in range(users)]
+
+    print(f"{users} users, {channels} channels,"
+          f" {len(memberships)} memberships")
+    for name, fn in (("dict scan", old_replay), ("roster", roster_replay)):
+        quit_t, nick_t = fn(memberships, nicks)
+        print(f"{name:>10}: QUIT {quit_t * 1000:8.2f}ms"
+              f"  NICK {nick_t * 1000:8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# Time a cold start of the bot up to the CAP LS it sends to the server.
+# Every run starts the start script in a fresh interpreter, with a new
+# configuration directory that points to a local socket, and stops the
+# bot when the CAP LS line arrives. This includes what
+# startup_importtime.py leaves out: loading the configuration and the
+# log, importing the modules, running the startup modules and
+# connecting. The median of the runs is reported and the exit status is
+# 1 if it is over the budget.
+#
+# Usage: python3 benchmarks/startup_cap_ls.py [budget_ms] [runs]
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import json
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+src = Path(__file__).resolve().parent.parent / "src"
+
+timeout = 30  # seconds to wait for the connection and for CAP LS
+
+
+def config(port):
+    """A configuration that verifies without asking anything and loads
+    only the core modules."""
+    return {
+        "sys": {"log_level": "info"},
+        "irc": {
+            "owners": [],
+            "connection": {
+                "network": "127.0.0.1",
+                "port": port,
+                "ssl": False,
+                "net_password": "",
+                "nickname": "drastikbot",
+                "username": "drastikbot",
+                "realname": "drastikbot",
+                "authentication": "",
+                "auth_password": ""
+            },
+            "channels": {},
+            "modules": {
+                "paths": {},
+                "global_prefix": ".",
+                "channel_prefix": {},
+                "blacklist": {},
+                "whitelist": {}
+            },
+            "user_acl": []
+        }
+    }
+
+
+def cap_ls():
+    """Start the bot and return the seconds until it sent CAP LS."""
+    with tempfile.TemporaryDirectory() as botdir, \
+            socket.socket() as server:
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        server.settimeout(timeout)
+        path = Path(botdir, "config.json")
+        path.write_text(json.dumps(config(server.getsockname()[1])))
+
+        start = time.perf_counter()
+        p = subprocess.Popen(
+            [sys.executable, "drastikbot.py", "-c", botdir], cwd=src,
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        try:
+            conn, _ = server.accept()
+            with conn, conn.makefile("rb") as f:
+                conn.settimeout(timeout)
+                for line in f:
+                    if line.startswith(b"CAP LS"):
+                        return time.perf_counter() - start
+            raise RuntimeError("The bot closed the connection before CAP LS")
+        finally:
+            p.kill()
+            p.wait()
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 500
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    times = sorted(cap_ls() for _ in range(runs))
+    median = statistics.median(times) * 1000
+
+    print(f"Start to CAP LS: {median:.1f}ms (median of {runs},"
+          f" best {times[0] * 1000:.1f}ms, worst {times[-1] * 1000:.1f}ms,"
+          f" budget {budget:.0f}ms)")
+
+    if median > budget:
+        print(f"Over budget by {median - budget:.1f}ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
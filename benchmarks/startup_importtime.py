@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# Profile the imports done before the bot can send CAP LS: the start
+# script and irc.worker, that it imports once the configuration is
+# verified. Every run is a fresh interpreter started with
+# ``-X importtime''. The slowest imports of the best run are listed and
+# the exit status is 1 if the total is over the budget.
+#
+# Only the imports are measured. Loading the configuration, importing
+# the modules and connecting also happen before CAP LS: see
+# startup_cap_ls.py for the time from the start of the process to it.
+#
+# Usage: python3 benchmarks/startup_importtime.py [budget_ms] [runs]
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import subprocess
+import sys
+from pathlib import Path
+
+src = Path(__file__).resolve().parent.parent / "src"
+
+# The imports of the start script
+statement = "import drastikbot, irc.worker"
+
+
+def importtime():
+    """Return [(self_us, cumulative_us, depth, name)] for every import,
+    in the order -X importtime reports them."""
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                       cwd=src, capture_output=True, text=True, check=True)
+    ret = []
+    for line in p.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        ret.append((int(self_us), int(cumulative), depth, name.strip()))
+    return ret
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 100
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    # Keep the fastest run, the others are slowed down by the system.
+    best = None
+    for _ in range(runs):
+        imports = importtime()
+        total = sum(i[1] for i in imports if i[2] == 0)
+        if best is None or total < best[0]:
+            best = (total, imports)
+    total, imports = best
+
+    print(f"{statement}: {total / 1000:.1f}ms (best of {runs},"
+          f" budget {budget:.0f}ms)")
+    print(f"{'self':>8} {'cumulative':>11}  module")
+    for self_us, cumulative, depth, name in sorted(
+            imports, key=lambda i: i[1], reverse=True)[:20]:
+        print(f"{self_us / 1000:7.1f}ms {cumulative / 1000:10.1f}ms"
+              f"  {'  ' * depth}{name}")
+
+    if total / 1000 > budget:
+        print(f"Over budget by {total / 1000 - budget:.1f}ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,36 +20,7 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-
-def verify(conf):
-    if "sys" not in conf:
-        return "sys"
-    if "log_level" not in conf["sys"]:
-        return "sys:log_level"
-    if "irc" not in conf:
-        return "irc"
-    if "owners" not in conf["irc"]:
-        return "irc:owners"
-    if "connection" not in conf["irc"]:
-        return "irc:connection"
-    if "channels" not in conf["irc"]:
-        return "irc:channels"
-    if "modules" not in conf["irc"]:
-        return "irc:modules"
-    if "paths" not in conf["irc"]["modules"]:
-        return "irc:modules:paths"
-    if "global_prefix" not in conf["irc"]["modules"]:
-        return "irc:modules:global_prefix"
-    if "channel_prefix" not in conf["irc"]["modules"]:
-        return "irc:modules:channel_prefix"
-    if "blacklist" not in conf["irc"]["modules"]:
-        return "irc:modules:blacklist"
-    if "whitelist" not in conf["irc"]["modules"]:
-        return "irc:modules:whitelist"
-    if "user_acl" not in conf["irc"]:
-        return "irc:user_acl"
-
-    return 0  # Verification passed
+from dbotconf import verify
 
 
 def interactive_verify(conf):
@@ -73,6 +44,9 @@ def interactive_verify(conf):
     }
 
     i = verify(conf.conf)
+    if i == 0:
+        return  # Nothing to ask, leave the file as it is
+
     while i != 0:
         dispatch[i](conf.conf)
         i = verify(conf.conf)
@@ -56,4 +56,4 @@ def get_directory_path(directory):
 
 # IRCv3
 ircv3_version = "301"
-ircv3_req = ("sasl")
+ircv3_req = ("sasl", "chghost", "multi-prefix", "userhost-in-names")
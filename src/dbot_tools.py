@@ -23,11 +23,13 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
+import atexit
 import datetime
 import json
 import sys
+import threading
+import time
 from pathlib import Path
-from dbotconf import Configuration
 
 
 def text_fix(line):
@@ -61,31 +63,77 @@ class Logger:
     """
     This class provides minimal logging functionality.
     It supports two logging modes: INFO, DEBUG.
+
+    Lines are written either as free-form text (fmt="text") or as JSON
+    objects, one per line (fmt="json"). JSON records carry the fields:
+    timestamp, level, caller, module, command, latency and message.
+    The optional fields are passed as keyword arguments to info() and
+    debug() and are set to null when not given.
+
+    The log file is kept open and written through a buffered writer.
+    The buffer is flushed on every INFO line, on a DEBUG line if more
+    than ``flush_interval'' seconds passed since the last flush and
+    when the program exits.
     """
 
-    def __init__(self, level, path):
+    flush_interval = 1  # seconds
+
+    def __init__(self, level, path, fmt="text"):
         self.log_mode = level
+        self.log_format = fmt
 
         if not path.exists():
             path.parent.mkdir(parents=True, exist_ok=True)
 
         self.log_file = path
-
-    def log_write(self, msg, line):
-        with open(self.log_file, 'a+') as log:
-            log.write(line + '\n')
-
-    def info(self, msg):
+        self._lock = threading.Lock()
+        self._fp = open(path, 'a', encoding='utf-8')
+        self._last_flush = time.monotonic()
+        atexit.register(self.flush)
+
+    def flush(self):
+        with self._lock:
+            self._fp.flush()
+            self._last_flush = time.monotonic()
+
+    def log_write(self, line, force_flush=False):
+        with self._lock:
+            self._fp.write(line + '\n')
+            now = time.monotonic()
+            if force_flush or now - self._last_flush > self.flush_interval:
+                self._fp.flush()
+                self._last_flush = now
+
+    def _json_line(self, dt, level, caller, msg, fields):
+        return json.dumps({
+            "timestamp": dt.isoformat(),
+            "level": level,
+            "caller": caller,
+            "module": fields.get("module"),
+            "command": fields.get("command"),
+            "latency": fields.get("latency"),
+            "message": msg
+        }, default=str)
+
+    def info(self, msg, **fields):
         if self.log_mode == 'info' or self.log_mode == 'debug':
             dt = datetime.datetime.now()
-            line = f"{dt} - INFO - {msg}"
+            if self.log_format == 'json':
+                caller_name = sys._getframe(1).f_code.co_name
+                line = self._json_line(dt, "INFO", caller_name, msg, fields)
+            else:
+                line = f"{dt} - INFO - {msg}"
             print(msg)
-            self.log_write(msg, line)
+            self.log_write(line, force_flush=True)
 
-    def debug(self, msg):
+    def debug(self, msg, **fields):
         if self.log_mode == 'debug':
             caller_name = sys._getframe(1).f_code.co_name
             dt = datetime.datetime.now()
-            line = f"{dt} - DEBUG - {caller_name} - {msg}"
-            print(line)
-            self.log_write(msg, line)
+            text_line = f"{dt} - DEBUG - {caller_name} - {msg}"
+            if self.log_format == 'json':
+                line = self._json_line(dt, "DEBUG", caller_name, msg, fields)
+            else:
+                line = text_line
+            print(text_line)
+            self.log_write(line)
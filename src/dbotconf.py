@@ -128,23 +128,28 @@ def is_joined_uacl(mask, conf):
     return conf.has_channel(channel) or channel == "*"
 
 
-def is_banned_uacl(mask, channel, nick, user, host, module):
+def is_banned_uacl(mask, channel, nick, user, host, module, casemap=None):
     """Check if a user is banned from using the bot.
 
     :param mask: A ``mask'' string in the following format:
                  channel nickname!username@hostmask time modules
     A * wildcard is allowed in front of the username and the hostmask.
+    :param casemap: The server's casemapping (irc.casemap.Casemapping) used
+                    to compare the channel and the nickname. If None an
+                    ASCII caseless comparison is used.
     """
+    equal = is_ascii_cl if casemap is None else casemap.equal
+
     m_channel = mask["channel"]
-    if not (is_ascii_cl(m_channel, channel) or m_channel == "*"):
+    if not (m_channel == "*" or equal(m_channel, channel)):
         return False
 
     m_nick = mask["nick"]
-    if not (is_ascii_cl(m_nick, nick) or m_nick == "*"):
+    if not (m_nick == "*" or equal(m_nick, nick)):
         return False
 
     return is_user_uacl(mask, user) and is_host_uacl(mask, host) \
-        and is_timestamp_uacl(mask, host) and is_module_uacl(mask, module)
+        and is_timestamp_uacl(mask) and is_module_uacl(mask, module)
 
 
 def is_user_uacl(mask, user):
@@ -202,6 +207,39 @@ def is_module_uacl(mask, module):
 # Configuration: config file read/write interface
 # ====================================================================
 
+def verify(conf):
+    """Return the first missing setting of the configuration dict
+    ``conf'' or 0 if it has all of them. conf_setup asks for them."""
+    if "sys" not in conf:
+        return "sys"
+    if "log_level" not in conf["sys"]:
+        return "sys:log_level"
+    if "irc" not in conf:
+        return "irc"
+    if "owners" not in conf["irc"]:
+        return "irc:owners"
+    if "connection" not in conf["irc"]:
+        return "irc:connection"
+    if "channels" not in conf["irc"]:
+        return "irc:channels"
+    if "modules" not in conf["irc"]:
+        return "irc:modules"
+    if "paths" not in conf["irc"]["modules"]:
+        return "irc:modules:paths"
+    if "global_prefix" not in conf["irc"]["modules"]:
+        return "irc:modules:global_prefix"
+    if "channel_prefix" not in conf["irc"]["modules"]:
+        return "irc:modules:channel_prefix"
+    if "blacklist" not in conf["irc"]["modules"]:
+        return "irc:modules:blacklist"
+    if "whitelist" not in conf["irc"]["modules"]:
+        return "irc:modules:whitelist"
+    if "user_acl" not in conf["irc"]:
+        return "irc:user_acl"
+
+    return 0  # Verification passed
+
+
 class Configuration:
     """
     The Config class provides easy reading and writing to the
@@ -233,6 +271,12 @@ class Configuration:
         except KeyError:
             return "info"
 
+    def get_sys_log_format(self):
+        try:
+            return self.conf["sys"]["log_format"]
+        except KeyError:
+            return "text"
+
     def get_sys_log_dir(self):
         try:
             return self.conf["sys"]["log_dir"]
@@ -251,6 +295,29 @@ class Configuration:
     def get_ssl(self):
         return self.conf["irc"]["connection"].get("ssl", False)
 
+    def get_servers(self):
+        """Get the servers of the network in order of preference. The
+        main server is followed by the optional list of alternatives in
+        irc.connection.servers:
+            [{"network": "irc.example.org", "port": 6697, "ssl": true}]
+        Missing values are taken from the main server.
+        """
+        main = {
+            "host": self.get_host(),
+            "port": self.get_port(),
+            "ssl": self.get_ssl(),
+            "password": self.get_network_passoword()
+        }
+        ret = [main]
+        for server in self.conf["irc"]["connection"].get("servers", []):
+            ret.append({
+                "host": server.get("network", main["host"]),
+                "port": server.get("port", main["port"]),
+                "ssl": server.get("ssl", main["ssl"]),
+                "password": server.get("net_passoword", main["password"])
+            })
+        return ret
+
     def get_nickname(self):
         return self.conf["irc"]["connection"]["nickname"]
 
@@ -281,6 +348,14 @@ class Configuration:
     def get_msg_delay(self):
         return self.conf["irc"]["connection"].get("msg_delay", 1)
 
+    def get_keepalive_interval(self):
+        # Seconds between the PINGs sent to measure the lag
+        return self.conf["irc"]["connection"].get("keepalive", 30)
+
+    def get_max_lag(self):
+        # Reconnect when a PING is unanswered for that many seconds
+        return self.conf["irc"]["connection"].get("max_lag", 120)
+
     def get_channels(self):
         return self.conf["irc"]["channels"]
 
@@ -310,6 +385,34 @@ class Configuration:
         self.conf["irc"]["modules"]["settings"][module] = settings
         self.save()
 
+    def get_module_slow_threshold(self):
+        """Module calls that take longer than this (in seconds) are
+        logged as slow."""
+        return self.conf["irc"]["modules"].get("slow_threshold", 2)
+
+    def get_module_timeout(self):
+        return self.conf["irc"]["modules"].get("timeout", 60)
+
+    def get_module_processes(self):
+        """Worker processes of the modules that run in processes. 0 to
+        use one per CPU."""
+        return self.conf["irc"]["modules"].get("processes", 0)
+
+    def get_module_import_workers(self):
+        """Threads importing the third party modules at startup. Set it
+        to 1 for modules that can not be imported concurrently."""
+        return self.conf["irc"]["modules"].get("import_workers", 8)
+
+    def get_commit_interval(self):
+        """Max seconds the writes of the modules to the database file
+        wait to be committed."""
+        return self.conf["irc"]["modules"].get("commit_interval", 1)
+
+    def get_memory_snapshot_interval(self):
+        """Seconds between the snapshots of the modules' in-memory
+        database. 0 disables them, and the restore at startup."""
+        return self.conf["irc"]["modules"].get("memory_snapshot", 300)
+
     def get_module_blacklist(self, module):
         try:
             return self.conf["irc"]["modules"]["blacklist"][module]
@@ -380,7 +483,7 @@ class Configuration:
         self.get_module_whitelist(module).remove(channel)
         self.save()
 
-    def check_channel_module_access(self, module, channel):
+    def check_channel_module_access(self, module, channel, casemap=None):
         """Check if the the given module/channel combination is allowed
         according to the configured access list (blacklist/whitelist)
         rules.
@@ -390,11 +493,17 @@ class Configuration:
         - The channel is not in a blacklist and it is in a whitelist.
         Otherwise it returns False.
 
+        Channel names are compared using ``casemap'' if it is given.
+
         @returns True If the module can be applied in this channel
                  False Otherwise
         """
         bl = self.get_module_blacklist(module)
         wl = self.get_module_whitelist(module)
+        if casemap is not None:
+            channel = casemap.key(channel)
+            bl = bl and [casemap.key(c) for c in bl]
+            wl = wl and [casemap.key(c) for c in wl]
         if (not bl or channel not in bl) and (not wl or channel in wl):
             return True
         return False
@@ -450,9 +559,10 @@ class Configuration:
         user = msg.get_user()
         host = msg.get_host()
         chan = msg.get_msgtarget()
+        casemap = getattr(msg, "casemap", None)
 
         for i in uacl:
-            if is_banned_uacl(i, chan, nick, user, host, module):
+            if is_banned_uacl(i, chan, nick, user, host, module, casemap):
                 return True
         return False
 
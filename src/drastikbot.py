@@ -23,17 +23,18 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
-import os
-import sys
-import argparse
-import traceback
-from pathlib import Path
+import time
+start_time = time.perf_counter()  # Before the imports, they are timed too
 
-import constants
-import conf_setup
-from dbotconf import Configuration
-from dbot_tools import Logger
-import irc.worker
+import os  # noqa: E402
+import sys  # noqa: E402
+import argparse  # noqa: E402
+import traceback  # noqa: E402
+from pathlib import Path  # noqa: E402
+
+import constants  # noqa: E402
+from dbotconf import Configuration, verify  # noqa: E402
+from dbot_tools import Logger  # noqa: E402
 
 
 def print_banner():
@@ -78,8 +79,11 @@ def cli_arg_state():
     ensure_dir_exists(botdir)
 
     conf = Configuration(constants.get_config_path(botdir))
-    # Verify the config file and prompt the user for input
-    conf_setup.interactive_verify(conf)
+    # Verify the config file and prompt the user for input. conf_setup
+    # is only imported when there is something to ask.
+    if verify(conf.conf) != 0:
+        import conf_setup
+        conf_setup.interactive_verify(conf)
 
     loglevel = conf.get_sys_log_level()
     if devmode:
@@ -89,7 +93,9 @@ def cli_arg_state():
     if logdir is None:
         logdir = constants.get_log_dir(botdir)
 
-    runlog = Logger(loglevel, Path(logdir, "runtime.log"))
+    logformat = conf.get_sys_log_format()
+
+    runlog = Logger(loglevel, Path(logdir, "runtime.log"), logformat)
 
     # Get the project's root directory
     program_path = os.path.dirname(os.path.abspath(__file__))
@@ -101,8 +107,10 @@ def cli_arg_state():
         "devmode": devmode,
         "loglevel": loglevel,
         "logdir": logdir,
+        "logformat": logformat,
         "runlog": runlog,
-        "modules": None
+        "modules": None,
+        "start_time": start_time  # time.perf_counter() at startup
     }
     return state
 
@@ -111,6 +119,9 @@ if __name__ == "__main__":
     print_banner()
     state = cli_arg_state()
     try:
+        # Imported after the configuration is verified, so that the
+        # interactive setup does not wait for the IRC code to load.
+        import irc.worker
         irc.worker.run(state)
     except Exception as e:
         logger = state["runlog"]
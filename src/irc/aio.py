@@ -0,0 +1,155 @@
+# coding=utf-8
+
+# Support for modules whose main() is a coroutine (async def). They run
+# on one asyncio event loop shared by every async module, so that many
+# calls waiting on I/O do not need a thread each.
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from irc.database import Cursor, cursor_call
+
+
+class BudgetExceeded(Exception):
+    """Raised by a call that was cancelled after its time budget."""
+
+
+class EventLoop:
+    """An asyncio event loop running in its own thread.
+
+    An async module must not block the loop: blocking calls should be
+    awaited through loop.run_in_executor(). Its output and database
+    calls are made through AsyncIRC and AsyncDatabase, which do that.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        # irc.send blocks, so it is called from this pool. One thread
+        # keeps the lines in the order they were sent.
+        self.out_executor = ThreadPoolExecutor(max_workers=1,
+                                               thread_name_prefix="aio-out")
+        self.thread = threading.Thread(target=self._run, name="aio",
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call(self, fn, data, irc, timeout=0):
+        """Run the coroutine fn(data, irc) on the loop. It is cancelled
+        and BudgetExceeded is raised if it takes longer than ``timeout''
+        seconds (0 for no limit). Returns a concurrent.futures.Future.
+        """
+        async def run():
+            if not timeout:
+                return await fn(data, irc)
+            try:
+                return await asyncio.wait_for(fn(data, irc), timeout)
+            except asyncio.TimeoutError:
+                data.cancel.set()
+                raise BudgetExceeded(f"Took longer than {timeout}s")
+
+        return asyncio.run_coroutine_threadsafe(run(), self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.out_executor.shutdown(wait=False)
+
+
+class AsyncOutput:
+    """irc.out for async modules: the methods of irc.irc.Output are
+    coroutines, e.g. ``await irc.out.privmsg(channel, text)''."""
+    def __init__(self, out, executor):
+        self._out = out
+        self._executor = executor
+
+    def __getattr__(self, name):
+        method = getattr(self._out, name)
+        if not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(method, *args, **kwargs))
+        return call
+
+
+class AsyncIRC:
+    """The ``irc'' argument of an async module's main(). It gives access
+    to everything the Drastikbot object has, but ``send'' and the
+    methods of ``out'' are coroutines."""
+    def __init__(self, irc, executor):
+        self._irc = irc
+        self._executor = executor
+        self.out = AsyncOutput(irc.out, executor)
+
+    def __getattr__(self, name):
+        return getattr(self._irc, name)
+
+    async def send(self, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(self._irc.send, *args,
+                                              **kwargs))
+
+
+class AsyncDatabase:
+    """A database of irc.database for async modules. The statements are
+    queued to the database thread and awaited, so no thread waits for
+    them:
+
+        dbc = await i.db_disk.execute("SELECT a FROM foo WHERE b = ?;",
+                                      (b,))
+        dbc.fetchone()
+    """
+    def __init__(self, db):
+        self.db = db
+
+    async def run(self, fn, *args):
+        """See ThreadedDatabase.run()."""
+        return await asyncio.wrap_future(self.db.submit(fn, *args))
+
+    async def _cursor(self, method, *args):
+        return Cursor(self.db, await self.run(cursor_call, method, *args))
+
+    async def execute(self, sql, parameters=()):
+        return await self._cursor("execute", sql, parameters)
+
+    async def executemany(self, sql, seq_of_parameters):
+        return await self._cursor("executemany", sql,
+                                  list(seq_of_parameters))
+
+    async def executescript(self, sql_script):
+        return await self._cursor("executescript", sql_script)
+
+    async def batch(self, statements):
+        """See ThreadedDatabase.batch()."""
+        statements = list(statements)
+        return await self.run(lambda conn: self.db.batch(statements))
+
+    async def commit(self):
+        self.db.commit()  # Does not block
+
+    async def rollback(self):
+        self.db.rollback()
@@ -0,0 +1,94 @@
+# coding=utf-8
+
+# Casemapping of nicknames and channel names, as advertised by the server
+# with the CASEMAPPING token of RPL_ISUPPORT (005).
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import sys
+
+
+_upper = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_lower = "abcdefghijklmnopqrstuvwxyz"
+
+tables = {
+    "ascii": str.maketrans(_upper, _lower),
+    # []\~ are the uppercase of {}|^
+    "rfc1459": str.maketrans(_upper + "[]\\~", _lower + "{}|^"),
+    # Like rfc1459 but without ~ and ^
+    "strict-rfc1459": str.maketrans(_upper + "[]\\", _lower + "{}|"),
+}
+
+# The casemapping servers use when CASEMAPPING is not advertised.
+default = "rfc1459"
+
+
+def resolve(name):
+    """The name of the casemapping used for the advertised ``name''.
+    Unknown casemappings fall back to the default."""
+    name = name.lower()
+    if name == "rfc7613" or name in tables:
+        return name
+    return default
+
+
+class Casemapping:
+    """Normalize nicknames and channel names to lookup keys.
+
+    The keys are interned and cached, so that normalizing a name that
+    was seen before (the common case for nicknames and channels) is a
+    dictionary lookup and comparing two keys is cheap.
+
+    An instance is shared by the bot's roster and the message objects.
+    Use set() to change the casemapping in place when the server
+    advertises a different one.
+    """
+    cache_size = 16384
+
+    def __init__(self, name=default):
+        self.set(name)
+
+    def set(self, name):
+        name = resolve(name)
+        if name == "rfc7613":
+            self._table = None  # Unicode casefolding
+        else:
+            self._table = tables[name]
+        self.name = name
+        self._cache = {}
+
+    def key(self, s):
+        try:
+            return self._cache[s]
+        except KeyError:
+            pass
+        if self._table is None:
+            k = sys.intern(s.casefold())
+        else:
+            k = sys.intern(s.translate(self._table))
+        if len(self._cache) >= self.cache_size:
+            self._cache = {}
+        self._cache[s] = k
+        return k
+
+    __call__ = key
+
+    def equal(self, x, y):
+        """Is x a caseless match for y?"""
+        return self.key(x) == self.key(y)
@@ -0,0 +1,355 @@
+# coding=utf-8
+
+# Databases shared by the modules. Modules get them through the
+# db_memory and db_disk fields of their callback data.
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+class ThreadedDatabase:
+    """A SQLite connection that is safe to use from the module threads.
+
+    Only one thread, owned by the database, touches the connection. The
+    other threads send it the work and wait for the result, so that
+    statements never interleave on a cursor or inside a transaction.
+
+    It can be used like a sqlite3.Connection:
+
+        dbc = i.db_memory.cursor()
+        dbc.execute("SELECT a FROM foo WHERE b = ?;", (b,))
+        dbc.fetchone()
+
+    For many statements at once use batch(), that applies them in a
+    single transaction, or run() to use the connection directly.
+
+    The connection is shared, so rollback() can not undo the statements
+    of one caller and raises sqlite3.NotSupportedError. Work that must
+    be applied whole or not at all should use batch() or run().
+    """
+    name = "database"
+
+    def __init__(self, database):
+        self.database = database
+        self.conn = None  # Only used by the database thread
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=self.name,
+                                        daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        return sqlite3.connect(self.database, isolation_level=None)
+
+    def _timeout(self):
+        """Seconds the database thread may wait for work before calling
+        _tick(). None to wait forever."""
+        return None
+
+    def _tick(self):
+        """Called in the database thread after every call of run() and
+        when _timeout() expires."""
+        pass
+
+    def _run(self):
+        self.conn = self._connect()
+        while True:
+            try:
+                fn, args, future = self._queue.get(timeout=self._timeout())
+            except queue.Empty:
+                self._tick()
+                continue
+            if fn is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(self.conn, *args))
+            except BaseException as e:
+                future.set_exception(e)
+            self._tick()
+        self.conn.close()
+
+    def run(self, fn, *args):
+        """Call fn(connection, *args) in the database thread and return
+        its result. Nothing else uses the connection until fn returns.
+        """
+        if threading.current_thread() is self._thread:
+            return fn(self.conn, *args)  # Called from fn
+        return self.submit(fn, *args).result()
+
+    def submit(self, fn, *args):
+        """Like run(), but return a concurrent.futures.Future of the
+        result instead of waiting for it."""
+        future = Future()
+        self._queue.put((fn, args, future))
+        return future
+
+    # sqlite3.Connection interface ###################################
+
+    def cursor(self):
+        return Cursor(self)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        raise sqlite3.NotSupportedError(
+            "The database is shared, rollback() can not undo the"
+            " statements of one caller. Use batch() or run() instead.")
+
+    def close(self):
+        """Stop the database thread. Only for the owner of the database,
+        the modules get a ModuleDatabase."""
+        self._queue.put((None, (), None))
+        self._thread.join()
+
+    # Batches ########################################################
+
+    def batch(self, statements):
+        """Execute [(sql, parameters)] in one transaction. If any of them
+        fails none is applied and the exception is raised. Returns the
+        rows of every statement.
+        """
+        return self.run(_batch, list(statements))
+
+
+class MemoryDatabase(ThreadedDatabase):
+    """The in-memory database of the modules. See ThreadedDatabase.
+
+    Every statement is committed when it is executed, so commit() does
+    nothing.
+
+    The database can be saved to ``snapshot_path'' with snapshot() and
+    loaded from it with restore(), so that what the modules keep in it
+    survives restarts.
+    """
+    name = "db_memory"
+
+    def __init__(self, database=":memory:", snapshot_path=None):
+        self.snapshot_path = snapshot_path
+        self._changes = 0  # conn.total_changes at the last snapshot
+        super().__init__(database)
+
+    # Snapshots ######################################################
+
+    def snapshot(self, force=False):
+        """Copy the database to snapshot_path with the SQLite backup API.
+        Nothing is written if the database did not change since the last
+        snapshot, unless ``force'' is True. Returns True if written.
+        """
+        return self.run(self._snapshot, force)
+
+    def _snapshot(self, conn, force):
+        if not force and conn.total_changes == self._changes:
+            return False
+        # Write a copy and move it in place, so that a crash in the middle
+        # does not leave a broken snapshot behind.
+        tmp = f"{self.snapshot_path}.tmp"
+        dst = sqlite3.connect(tmp)
+        try:
+            conn.backup(dst)
+        finally:
+            dst.close()
+        os.replace(tmp, self.snapshot_path)
+        self._changes = conn.total_changes
+        return True
+
+    def restore(self):
+        """Load the snapshot, if there is one, replacing the database.
+        Returns True if it was loaded."""
+        return self.run(self._restore)
+
+    def _restore(self, conn):
+        if not os.path.isfile(self.snapshot_path):
+            return False
+        src = sqlite3.connect(self.snapshot_path)
+        try:
+            src.backup(conn)
+        finally:
+            src.close()
+        self._changes = conn.total_changes
+        return True
+
+
+class DiskDatabase(ThreadedDatabase):
+    """The database file of the modules. See ThreadedDatabase.
+
+    Writes are coalesced: the transaction that sqlite3 opens before an
+    INSERT, UPDATE or DELETE is left open and committed at most
+    ``commit_interval'' seconds later, or once ``max_changes'' rows have
+    changed. A module's commit() only asks for that to happen, so the
+    writes of many calls share a single transaction and fsync. With WAL
+    and synchronous=NORMAL the database stays consistent after a crash,
+    losing at most the writes of the last interval.
+
+    Since the transaction is shared, rollback() can not undo the writes
+    of one module and raises. Use batch() or run() for work that must be
+    applied whole or not at all.
+
+    Call flush() to commit at once, e.g. before quitting.
+    """
+    name = "db_disk"
+
+    def __init__(self, database, commit_interval=1.0, max_changes=10000):
+        self.commit_interval = commit_interval
+        self.max_changes = max_changes
+        self._dirty_since = None  # time.monotonic() of the first write
+        self._changes = 0  # conn.total_changes at the last commit
+        super().__init__(database)
+
+    def _connect(self):
+        # Deferred transactions opened by sqlite3 on the first write.
+        conn = sqlite3.connect(self.database)
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        return conn
+
+    def _timeout(self):
+        if self._dirty_since is None:
+            return None
+        due = self._dirty_since + self.commit_interval
+        return max(0, due - time.monotonic())
+
+    def _tick(self):
+        conn = self.conn
+        if not conn.in_transaction:
+            self._dirty_since = None
+            return
+        if self._dirty_since is None:
+            self._dirty_since = time.monotonic()
+        due = time.monotonic() - self._dirty_since >= self.commit_interval
+        if due or conn.total_changes - self._changes >= self.max_changes:
+            self._commit(conn)
+
+    def _commit(self, conn):
+        conn.commit()
+        self._changes = conn.total_changes
+        self._dirty_since = None
+
+    def commit(self):
+        pass  # Committed by the database thread within commit_interval
+
+    def flush(self):
+        """Commit the pending writes now."""
+        self.run(self._commit)
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+class ModuleDatabase:
+    """The handle of a ThreadedDatabase given to the modules. It is used
+    like the database, but close() does nothing: the database is shared
+    by every module and closed by irc.modules.shutdown().
+    """
+    def __init__(self, db):
+        self.db = db
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    # The cursors of the handle, so that cursor.connection is the handle
+    cursor = ThreadedDatabase.cursor
+    execute = ThreadedDatabase.execute
+    executemany = ThreadedDatabase.executemany
+    executescript = ThreadedDatabase.executescript
+
+    def close(self):
+        pass
+
+
+def _batch(conn, statements):
+    # A savepoint works both on its own and inside an open transaction.
+    ret = []
+    conn.execute("SAVEPOINT batch;")
+    try:
+        for sql, parameters in statements:
+            ret.append(conn.execute(sql, parameters).fetchall())
+    except BaseException:
+        conn.execute("ROLLBACK TO batch;")
+        conn.execute("RELEASE batch;")
+        raise
+    conn.execute("RELEASE batch;")
+    return ret
+
+
+def cursor_call(conn, method, *args):
+    """Call a method of a new cursor. Returns what Cursor needs."""
+    c = conn.cursor()
+    getattr(c, method)(*args)
+    return c.fetchall(), c.rowcount, c.lastrowid, c.description
+
+
+class Cursor:
+    """A sqlite3.Cursor look-alike for ThreadedDatabase. The rows of a
+    query are fetched at once in the database thread."""
+
+    def __init__(self, db, result=([], -1, None, None)):
+        self.connection = db
+        self.arraysize = 1
+        self._set(result)
+
+    def _set(self, result):
+        rows, self.rowcount, self.lastrowid, self.description = result
+        self._rows = iter(rows)
+
+    def _call(self, method, *args):
+        self._set(self.connection.run(cursor_call, method, *args))
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._call("execute", sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._call("executemany", sql, list(seq_of_parameters))
+
+    def executescript(self, sql_script):
+        return self._call("executescript", sql_script)
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        return [row for _, row in zip(range(size), self._rows)]
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def close(self):
+        self._rows = iter(())
+
+    def __iter__(self):
+        return self._rows
@@ -24,12 +24,115 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 import socket
-import ssl
 import time
 import traceback
 
 import dbot_tools
+from irc.casemap import Casemapping, default as default_casemapping
+from irc.casemap import resolve as resolve_casemapping
+from irc.keepalive import Keepalive
 from irc.message import remove_formatting
+from irc.roster import Roster
+
+
+# RPL_ISUPPORT token parsers #########################################
+
+def parse_isupport_prefix(value):
+    """PREFIX=(qaohv)~&@%+ -> {"q": "~", "a": "&", ...} ordered from the
+    highest prefix to the lowest."""
+    if not value:
+        return {}
+    try:
+        modes, prefixes = value[1:].split(")", 1)
+    except ValueError:
+        return {}
+    return dict(zip(modes, prefixes))
+
+
+def parse_isupport_chanmodes(value):
+    """CHANMODES=b,k,l,imnpst -> {"A": ["b"], "B": ["k"], ...}"""
+    groups = value.split(",") if value else []
+    groups += [""] * (4 - len(groups))
+    return {t: list(g) for t, g in zip(("A", "B", "C", "D"), groups)}
+
+
+def parse_isupport_targmax(value):
+    """TARGMAX=PRIVMSG:4,NAMES:1,MONITOR: -> {"PRIVMSG": 4, "NAMES": 1,
+    "MONITOR": None}. None means that there is no limit."""
+    ret = {}
+    for entry in filter(None, value.split(",")):
+        command, _, limit = entry.partition(":")
+        ret[command.upper()] = _isupport_int(limit, None)
+    return ret
+
+
+def _isupport_int(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def split_text(text, size):
+    """Split UTF-8 encoded text in the fewest chunks of at most ``size''
+    bytes. The text is split at the last space that fits, which is then
+    dropped. A word longer than ``size'' is cut at a character boundary.
+    """
+    size = max(size, 4)  # Fit at least one UTF-8 character
+    chunks = []
+    while len(text) > size:
+        cut = text.rfind(b' ', 0, size + 1)
+        if cut > 0:
+            chunks.append(text[:cut])
+            text = text[cut + 1:]
+            continue
+        cut = size
+        while text[cut] & 0xC0 == 0x80:  # UTF-8 continuation byte
+            cut -= 1
+        chunks.append(text[:cut])
+        text = text[cut:]
+    chunks.append(text)
+    return chunks
+
+
+def plan_join(channels, size, limit=None):
+    """Pack {channel: key} in the fewest "JOIN #a,#b key" commands that
+    are at most ``size'' bytes long and have at most ``limit'' channels
+    (None for no limit). Keys match the channels by position, so the
+    channels with a key are placed first.
+
+    Returns a list of ("JOIN", channels[, keys]) tuples for irc.send.
+    """
+    keyed = [(c, k) for c, k in channels.items() if k]
+    keyless = [(c, "") for c, k in channels.items() if not k]
+
+    ret = []
+    chans, keys = [], []
+    length = 0  # len("JOIN " + ",".join(chans) + " " + ",".join(keys))
+    for channel, key in keyed + keyless:
+        # One more channel adds its name, the key and the separators.
+        add = len(channel.encode('utf-8')) + 1
+        if key:
+            add += len(key.encode('utf-8')) + 1
+        full = limit is not None and len(chans) >= limit
+        if chans and (full or length + add > size):
+            ret.append(_join_command(chans, keys))
+            chans, keys = [], []
+        if not chans:
+            length = len("JOIN")
+        chans.append(channel)
+        if key:
+            keys.append(key)
+        length += add
+    if chans:
+        ret.append(_join_command(chans, keys))
+    return ret
+
+
+def _join_command(channels, keys):
+    if keys:
+        return ("JOIN", ",".join(channels), ",".join(keys))
+    return ("JOIN", ",".join(channels))
 
 
 class Output:
@@ -43,17 +146,27 @@ class Output:
         self.irc.send(('INVITE', nick, channel))
 
     def join(self, channels):
-        for key, value in channels.items():
-            self.irc.send(('JOIN', key, value))
+        # Join as many channels per line as the server allows and pace
+        # the lines like the parts of a multipart message.
+        size = self.irc.linelen - 2  # CR-LF
+        limit = self.irc.get_targmax("JOIN", None)
+        for n, line in enumerate(plan_join(channels, size, limit)):
+            if n:
+                time.sleep(self.irc.msg_delay)
+            self.irc.send(line)
 
     def kick(self, channel, nick, msg):
         self.irc.send(('KICK', channel, nick, msg))
 
     def names(self, channels, server=""):
-        m = ["NAMES"]
-        m.extend(channels)
-        m.append(server)
-        self.irc.send(m)
+        # Send as few NAMES as the server's TARGMAX allows.
+        channels = list(channels)
+        limit = self.irc.get_targmax("NAMES") or len(channels)
+        for n in range(0, len(channels), limit):
+            m = ["NAMES", ",".join(channels[n:n + limit])]
+            if server:
+                m.append(server)
+            self.irc.send(m)
 
     def nick(self, nick):
         self.irc.send(('NICK', nick))
@@ -64,6 +177,9 @@ class Output:
     def part(self, channel, msg):
         self.irc.send(('PART', channel), msg)
 
+    def ping(self, token):
+        self.irc.send(("PING", token))
+
     def pong(self, server1, server2=""):
         if server2:
             self.irc.send(("PONG", server1, server2))
@@ -86,86 +202,180 @@ class Drastikbot():
         # IRC command messages
         self.out = Output(self)
 
-        self.reconnect_delay = 0
         self.sigint = 0
-        # Message length used by irc.send
-        # (TODO: The bot should dynamically change it based on the bot's
-        # nickname and hostmask length)
-        self.msg_len = 400
+        # Max length in bytes, including CR-LF, of a line sent by
+        # irc.send. The server prepends the bot's hostmask to the
+        # messages it relays and the result must fit in LINELEN, so it
+        # is recomputed whenever the hostmask changes.
+        self.msg_len = 0  # Set by update_msg_len()
         self.msg_delay = 1  # 1 second
 
         # Runtime Variables
         self.curr_nickname = ''        # Nickname currently used
         self.bot_hostmask = ''         # Hostmask issued by the server
+        self.bot_user = ''             # User part of bot_hostmask
+        self.bot_host = ''             # Host part of bot_hostmask
         self.alt_nickname = False      # Alternative nickname used
+        self.server = None             # irc.servers.Server connected to
         self.connected_ip = ''         # IP of the connected IRC server
         self.connected_host = ''       # Hostname of the connected server
         self.ircv3_enabled = []  # IRCv3 Server Capabilities Acknowledged
+        self.cap_pending = 0  # CAP REQ lines not answered yet
         # sasl_state = 0: Not tried | 1: Success | 2: Fail | 3: In progress
         self.sasl_state = 0
         self.conn_state = 0  # 0: Disconnected | 1: Registering | 2: Connected
         self.botmodes = []   # [x,I] Modes returned after registration
 
+        # Lag measurement. Started by the worker once connected.
+        self.keepalive = Keepalive(self,
+                                   self.conf.get_keepalive_interval(),
+                                   self.conf.get_max_lag())
+
         # Connection Status
-        self.channels = {}  # {"channel": ["mode"]}
-        self.names = {}  # {"channel": [{"name": ["mode"]}]}
+        # {channel_key: ["mode"]} The keys are casemapped like those
+        # of the roster.
+        self.channels = {}
 
         # IRC server features
-        # They are to be set by RPL_ISUPPORT or other mechanisms.
+        # They are set by RPL_ISUPPORT (see apply_isupport()).
         # The default values provided are set for max compatibility.
+        self.isupport = {}  # {"TOKEN": "value"} as advertised
         self.prefix = {"q": "~", "a": "&", "o": "@", "h": "%", "v": "+"}
         self.chantypes = {"#", "&", "+", "!"}  # RFC 2812 channel types
         self.chanmodes = {"A": [], "B": [], "C": [], "D": []}
+        self.nicklen = 9  # RFC 2812
+        self.channellen = 50  # RFC 2812
+        self.targmax = {}  # {"COMMAND": max targets or None for no limit}
+        self.maxtargets = None  # Max targets for PRIVMSG/NOTICE
+        self.linelen = 512  # Including CR-LF
+        # Used to compare nicknames and channels. Shared by the messages.
+        self.casemapping = Casemapping()
+
+        # Roster of the channel members. Can also be read as:
+        # {"channel": {"name": ["mode"]}}
+        self.names = Roster(self.casemapping)
+
+        self.update_msg_len()
+
+    def set_casemapping(self, name):
+        self.casemapping.set(name)
+        self.names.rekey()
+        self.channels = {self.casemapping(channel): modes
+                         for channel, modes in self.channels.items()}
+
+    # RPL_ISUPPORT ###################################################
+
+    def apply_isupport(self, tokens):
+        """Update the server features with the tokens of an RPL_ISUPPORT
+        reply. ``tokens'' is {"TOKEN": value} where a value of None means
+        that the token was negated and should be reset to its default.
+        """
+        for name, value in tokens.items():
+            if value is None:
+                self.isupport.pop(name, None)
+            else:
+                self.isupport[name] = value
+
+        isupport = self.isupport
+
+        if "PREFIX" in isupport:
+            self.prefix = parse_isupport_prefix(isupport["PREFIX"])
+        else:
+            self.prefix = {"q": "~", "a": "&", "o": "@", "h": "%", "v": "+"}
+        self.names.prefixes = "".join(self.prefix.values())
+
+        if "CHANTYPES" in isupport:
+            self.chantypes = set(isupport["CHANTYPES"])
+        else:
+            self.chantypes = {"#", "&", "+", "!"}
+
+        self.chanmodes = parse_isupport_chanmodes(
+            isupport.get("CHANMODES", ""))
+        self.nicklen = _isupport_int(isupport.get("NICKLEN"), 9)
+        self.channellen = _isupport_int(isupport.get("CHANNELLEN"), 50)
+        self.targmax = parse_isupport_targmax(isupport.get("TARGMAX", ""))
+        self.maxtargets = _isupport_int(isupport.get("MAXTARGETS"), None)
+        self.linelen = _isupport_int(isupport.get("LINELEN"), 512)
+
+        # Compared by the casemapping it resolves to, so that an unknown
+        # one does not rekey the roster on every RPL_ISUPPORT.
+        casemapping = isupport.get("CASEMAPPING") or default_casemapping
+        if resolve_casemapping(casemapping) != self.casemapping.name:
+            self.set_casemapping(casemapping)
+
+        self.update_msg_len()
+
+    def get_targmax(self, command, default=1):
+        """Get the max number of comma separated targets the server
+        accepts for ``command''. None means that there is no limit.
+        """
+        command = command.upper()
+        if command in self.targmax:
+            return self.targmax[command]
+        if command in ("PRIVMSG", "NOTICE"):
+            if "MAXTARGETS" in self.isupport:
+                return self.maxtargets
+        return default
+
+    def is_curr_nickname(self, nickname):
+        return self.casemapping.equal(nickname, self.curr_nickname)
+
+    # Hostmask #######################################################
+
+    def set_hostmask(self, user=None, host=None):
+        """Update the user and host the server shows for the bot and
+        recompute msg_len. Parts that are None are left unchanged.
+        """
+        if user:
+            self.bot_user = user
+        if host:
+            self.bot_host = host
+        self.update_msg_len()
+
+    def update_msg_len(self):
+        """Compute msg_len from the bot's hostmask and the server's
+        LINELEN. Call it after the nickname or the hostmask changes.
+
+        The server relays messages as ":nick!user@host PRIVMSG ..." so
+        the hostmask takes space from every line. Until the server has
+        told us the hostmask, the worst case is assumed: an ident that
+        did not respond ("~user") and a host of 63 bytes, the longest
+        hostname label.
+        """
+        nickname = self.curr_nickname or self.conf.get_nickname()
+        if self.bot_user and self.bot_host:
+            user, host = self.bot_user, self.bot_host
+            self.bot_hostmask = f"{nickname}!{user}@{host}"
+        else:
+            user = self.bot_user or f"~{self.conf.get_user()}"
+            host = self.bot_host or "x" * 63
+        prefix = f":{nickname}!{user}@{host} "
+        self.msg_len = self.linelen - len(prefix.encode('utf-8'))
 
-    def set_msg_len(self, nick_ls):
-        u = f"{nick_ls[0]}!{nick_ls[1]}@{nick_ls[2]} "
-        c = len(u.encode('utf-8'))
-        self.msg_len = 512 - c
+    # Send ###########################################################
 
     def send(self, cmds, text=None):
         cmds = [dbot_tools.text_fix(cmd) for cmd in cmds]
         if text:
             text = dbot_tools.text_fix(text)
             text = self._apply_output_filter(text)
-            tosend = f"{' '.join(cmds)} :{text}"
+            # Split the text over as many lines as needed. Every line
+            # repeats the command: "PRIVMSG #channel :<text>\r\n"
+            head = f"{' '.join(cmds)} :".encode('utf-8')
+            size = self.msg_len - 2 - len(head)
+            lines = [head + t for t in split_text(text.encode('utf-8'), size)]
         else:
-            tosend = ' '.join(cmds)  # for commands
-        try:
-            tosend = tosend.encode('utf-8')
-            multipart = False
-            remainder = 0
-            if len(tosend) + 2 > self.msg_len:
-                # Handle messages that are too long to fit in one message.
-                # Truncate messages at the last space found to avoid breaking
-                # utf-8.
-                tosend = tosend[:self.msg_len].rsplit(b' ', 1)
-                remainder = len(tosend[1])
-                multipart = True
-                tosend = tosend[0]
-
-            tosend = tosend + b'\r\n'
-            self.irc_socket.send(tosend)
-        except Exception:
-            self.log.debug(f'Exception on send() @ irc.py:'
-                           f'\n{traceback.format_exc()}')
-            return self.irc_socket.close()
-
-        # https://tools.ietf.org/html/rfc2812.html#section-2.3
-        # NOTE: 2) IRC messages are limited to 512 characters in length.
-        # With CR-LF we are left with 510 characters to use
-        #
-        # If the input text is longer than 510 send the rest.
-        # "limit" decrements after every message and is used to control
-        # the amount of messages the bot is allowed to send. The value
-        # is set to -1 by default, which means it can send an infinite
-        # amount of messages, since zero will never be met in the if
-        # statement below.
-        if multipart:
-            time.sleep(self.msg_delay)
-            irc_msg_len = len(' '.join(cmds).encode('utf-8'))
-            tr = self.msg_len - 2 - irc_msg_len - remainder
-            t = text.encode('utf-8')[tr:]
-            self.send(cmds, t)
+            lines = [' '.join(cmds).encode('utf-8')]  # for commands
+
+        for n, line in enumerate(lines):
+            if n:
+                time.sleep(self.msg_delay)
+            try:
+                self.irc_socket.send(line + b'\r\n')
+            except Exception:
+                self.log.debug(f'Exception on send() @ irc.py:'
+                               f'\n{traceback.format_exc()}')
+                return self.irc_socket.close()
 
     def _apply_output_filter(self, text):
         o_filter = self.conf.get_output_filter()
@@ -184,66 +394,70 @@ class Drastikbot():
 
         return " ".join(tokens)
 
-    # Delay ##########################################################
-
-    def increment_delay(self):
-        '''Increment the self.reconnect_delay variable.
-
-        If the delay is 0 it is set to 10 seconds. The delay is doubled on
-        every call of this method until a delay of 10 minutes is reached.
-        '''
-        if self.reconnect_delay == 0:
-            self.reconnect_delay = 10  # 10 sec.
-        elif self.reconnect_delay < 600:  # 10 mins.
-            self.reconnect_delay *= 2
-        # Make sure that the maximum delay is 600 seconds (10 minutes).
-        if self.reconnect_delay > 600:  # 10 mins.
-            self.reconnect_delay = 600
-
-        return self.reconnect_delay
-
-    def reset_delay(self):
-        self.reconnect_delay = 0
-
-    def delay_wait(self):
-        time.sleep(self.reconnect_delay)
-
     # Socket #########################################################
 
     def connect(self):
-        host = self.conf.get_host()
-        port = self.conf.get_port()
+        """Connect to the healthiest server of state["servers"], waiting
+        as long as its backoff says. Blocks until connected."""
+        servers = self.state["servers"]
         while 1:
+            server = servers.pick()
+            delay = servers.delay(server)
+            if delay:
+                self.log.info(f"! Connecting to {server}"
+                              f" in {delay:.1f} seconds.")
+                time.sleep(delay)
+
             try:
-                self.irc_socket = socket.create_connection((host, port), 300)
+                self.irc_socket = socket.create_connection(
+                    (server.host, server.port), 300)
             except Exception as e:
-                delay = self.increment_delay()
+                servers.failure(server)
                 self.log.debug("Exception on irc.Drastikbot.connect()"
                                f"\n{traceback.format_exc()}")
-                self.log.info(f"! {e}. Retrying in {delay} seconds.")
-                self.delay_wait()
-                self.log.info("! Reconnecting.")
+                self.log.info(f"! {server}: {e}")
                 continue
 
             try:
-                if self.conf.get_ssl():
+                if server.ssl:
+                    import ssl  # Slow to import and only needed here
                     context = ssl.create_default_context()
                     # context.check_hostname = False
                     # context.verify_mode = ssl.CERT_NONE
                     self.irc_socket = context.wrap_socket(
-                        self.irc_socket, server_hostname=host)
+                        self.irc_socket, server_hostname=server.host)
             except Exception as e:
                 self.irc_socket.close()  # Close the socket
-                delay = self.increment_delay()
+                servers.failure(server)
                 self.log.debug("Exception on irc.Drastikbot.connect()"
                                f"\n{traceback.format_exc()}")
-                self.log.info(f"! {e}. Retrying in {delay} seconds.")
-                self.delay_wait()
-                self.log.info("! Reconnecting.")
+                self.log.info(f"! {server}: {e}")
                 continue
 
-            if self.conf.get_network_passoword():
+            self.server = server
+            self.connected_host = server.host
+            self.connected_ip = self.irc_socket.getpeername()[0]
+            self.log.info(f"! Connected to {server}.")
+
+            if server.password:
                 # Authenticate if the server is password protected
-                self.send(('PASS', self.conf.get_network_password()))
+                self.send(('PASS', server.password))
 
             break  # We connected to the server. Stop the loop.
+
+    def registered(self):
+        """Called when the server accepts the registration (001)."""
+        self.conn_state = 2
+        self.state["servers"].success(self.server)
+        self.state["scheduler"].resume()
+
+    def drop(self):
+        """Drop the connection. The worker will reconnect."""
+        try:
+            self.irc_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Already closed
+
+    def get_lag(self):
+        """Get the lag to the server in seconds, or None if unknown."""
+        return self.keepalive.get_lag()
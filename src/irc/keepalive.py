@@ -0,0 +1,134 @@
+# coding=utf-8
+
+# Client side keepalive. The bot PINGs the server periodically to find
+# out if the connection is still alive and how much lag there is.
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import collections
+import threading
+import time
+
+
+class Keepalive:
+    """Send a PING with a unique token every ``interval'' seconds and
+    time the PONG that echoes it.
+
+    The connection is dropped, which makes the worker reconnect, when a
+    PING is not answered within ``max_lag'' seconds. Without it a half
+    open connection would only be noticed when the socket times out.
+
+    The last ``window'' lag samples are kept for the percentiles.
+    """
+    window = 120  # 1 hour at the default interval
+
+    def __init__(self, irc, interval=30, max_lag=120):
+        self.irc = irc
+        self.interval = interval
+        self.max_lag = max_lag
+
+        self.lag = None  # Last measured lag in seconds
+        self.samples = collections.deque(maxlen=self.window)
+        self.pending = {}  # {token: time.monotonic() when sent}
+        self.last_ping = 0.0
+        self.count = 0  # PINGs sent, used for the tokens
+        self.lock = threading.Lock()
+        self.job = None  # Scheduler job that calls tick()
+
+    def start(self, scheduler):
+        self.job = scheduler.every(1, self.tick, name="keepalive",
+                                   connected=False)
+
+    def stop(self):
+        if self.job is not None:
+            self.job.cancel()
+
+    def tick(self):
+        if self.irc.conn_state != 2:
+            return  # PING is only allowed after registering
+
+        now = time.monotonic()
+        lag = self.pending_lag(now)
+        if lag > self.max_lag:
+            self.irc.log.info(f"! No PONG for {lag:.0f} seconds."
+                              " Reconnecting.")
+            self.stop()
+            self.irc.drop()
+            return
+
+        if now - self.last_ping >= self.interval:
+            self.ping(now)
+
+    def ping(self, now):
+        with self.lock:
+            self.count += 1
+            token = f"drastikbot-{self.count}"
+            self.pending[token] = now
+            self.last_ping = now
+        self.irc.out.ping(token)
+
+    def pong(self, token):
+        """Handle the PONG reply for ``token''. Returns False if the
+        token is not ours."""
+        now = time.monotonic()
+        with self.lock:
+            sent = self.pending.pop(token, None)
+            if sent is None:
+                return False
+            # PONGs arrive in order. Older PINGs will not be answered.
+            for t in [t for t, s in self.pending.items() if s < sent]:
+                del self.pending[t]
+            self.lag = now - sent
+            self.samples.append(self.lag)
+        return True
+
+    def pending_lag(self, now=None):
+        """Seconds since the oldest unanswered PING was sent."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if not self.pending:
+                return 0.0
+            return now - min(self.pending.values())
+
+    def get_lag(self):
+        """The current lag: the last measured one, or the time the oldest
+        PING has been waiting for an answer if that is longer. None if
+        nothing was measured yet."""
+        pending = self.pending_lag()
+        if self.lag is None:
+            return pending or None
+        return max(self.lag, pending)
+
+    def percentile(self, p):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def to_dict(self):
+        with self.lock:
+            samples = list(self.samples)
+        return {
+            "lag": self.get_lag(),
+            "samples": len(samples),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": max(samples, default=None)
+        }
@@ -23,6 +23,7 @@
 import re
 
 import constants  # type: ignore
+from irc.casemap import Casemapping
 
 
 # ====================================================================
@@ -56,6 +57,9 @@ def remove_formatting(s):
 # ====================================================================
 
 class Base:
+    # Set by parse() to the casemapping of the connection.
+    casemap = Casemapping()
+
     def __init__(self, m):
         self.m = m
 
@@ -75,7 +79,7 @@ class Base:
     def is_nickname(self, nickname):
         if self.get_nickname() is None:
             return False
-        return self.get_nickname().lower() == nickname.lower()
+        return self.casemap.equal(self.get_nickname(), nickname)
 
     def get_user(self):
         return self.m["prefix"]["user"]
@@ -140,6 +144,9 @@ class MODE(Base):
     def _parse_modes(self, set_flag, modestring):
         modes = []
         for mode in modestring:
+            if mode == "+" or mode == "-":
+                set_flag = mode  # e.g. "+o-v"
+                continue
             modes.append({"flag": set_flag, "mode": mode,
                           "type": self._mode_type(mode)})
         return modes
@@ -185,7 +192,7 @@ class NOTICE(Base):
         self.irc = irc
 
     def is_pm(self):
-        return self.m["params"][0] == self.irc.curr_nickname
+        return self.irc.is_curr_nickname(self.m["params"][0])
 
     def get_msgtarget(self):
         return self.get_nickname() if self.is_pm() else self.m["params"][0]
@@ -227,6 +234,14 @@ class PING(Base):
             self.server2 = m["params"][1]
 
 
+class PONG(Base):
+    def __init__(self, m):
+        super().__init__(m)
+
+    def get_token(self):
+        return self.get_params()[-1]
+
+
 class PRIVMSG(Base):
     def __init__(self, irc, m):
         super().__init__(m)
@@ -248,7 +263,7 @@ class PRIVMSG(Base):
         self.args = args
 
     def is_pm(self):
-        return self.m["params"][0] == self.irc.curr_nickname
+        return self.irc.is_curr_nickname(self.m["params"][0])
 
     def get_msgtarget(self):
         return self.get_nickname() if self.is_pm() else self.m["params"][0]
@@ -272,6 +287,17 @@ class PRIVMSG(Base):
         return self.args.strip()
 
 
+class CHGHOST(Base):
+    def __init__(self, m):
+        super().__init__(m)
+
+    def get_new_user(self):
+        return self.get_params()[0]
+
+    def get_new_host(self):
+        return self.get_params()[1]
+
+
 class Cap(Base):
     def __init__(self, m):
         super().__init__(m)
@@ -282,7 +308,8 @@ class Cap(Base):
     def get_subcommand(self):
         return {
             "LS": CapLs,
-            "ACK": CapAck
+            "ACK": CapAck,
+            "NAK": CapNak
         }[self.m["params"][1]](self.m)
 
 
@@ -298,7 +325,9 @@ class CapLs:
         return [x for x in self.m["params"][-1].split(" ") if x]
 
     def get_req(self):
-        return [x for x in self.get_list() if x in constants.ircv3_req]
+        # Capabilities can have values (CAP 302): "sasl=PLAIN,EXTERNAL"
+        caps = [x.split("=", 1)[0] for x in self.get_list()]
+        return [x for x in caps if x in constants.ircv3_req]
 
 
 class CapAck:
@@ -316,6 +345,56 @@ class CapAck:
         return [x for x in self.get_list() if x[:1] != "-"]
 
 
+class CapNak:
+    def __init__(self, m):
+        self.m = m
+
+    def __str__(self):
+        return "NAK"
+
+    def get_list(self):
+        # The capabilities of the refused CAP REQ, none of them is enabled
+        return [x for x in self.m["params"][-1].split(" ") if x]
+
+
+class RPL_WELCOME_001(Base):
+    def __init__(self, m):
+        super().__init__(m)
+
+    def get_nickname(self):
+        return self.get_params()[0]
+
+    def get_hostmask(self):
+        """Get the hostmask of the client from the welcome text as a
+        prefix dictionary. Most servers end the text with it: "Welcome to
+        the Network nick!user@host". None is returned if it is missing.
+        """
+        words = self.get_params()[-1].split()
+        if not words:
+            return None
+        prefix = parse_prefix(words[-1])
+        if "user" not in prefix or prefix["nickname"] != self.get_nickname():
+            return None
+        return prefix
+
+
+class RPL_WHOREPLY_352(Base):
+    def __init__(self, m):
+        super().__init__(m)
+
+    def get_channel(self):
+        return self.get_params()[1]
+
+    def get_user(self):
+        return self.get_params()[2]
+
+    def get_host(self):
+        return self.get_params()[3]
+
+    def get_nickname(self):
+        return self.get_params()[5]
+
+
 class RPL_NAMREPLY_353(Base):
     def __init__(self, irc, m):
         super().__init__(m)
@@ -331,19 +410,76 @@ class RPL_NAMREPLY_353(Base):
         return self.get_params()[2]
 
     def get_names(self):
-        ret = {}
-        nlist = self.get_params()[3].split()
-        for n in nlist:
-            prefix = n[:1]
-            if prefix in self.irc.prefix.values():
-                nick = n[1:]
-                ret[nick] = [prefix]
-            else:
-                ret[n] = [""]
+        """Get {nickname: [prefixes]}. With IRCv3 multi-prefix every
+        prefix of the user is listed, otherwise only the highest. Users
+        without a prefix have [""].
+        """
+        return {nick: prefixes or [""]
+                for nick, prefixes, _ in self._parse_names()}
+
+    def get_hosts(self):
+        """Get {nickname: (user, host)} for the names that came with a
+        hostmask (IRCv3 userhost-in-names)."""
+        return {nick: host for nick, _, host in self._parse_names()
+                if host is not None}
+
+    def _parse_names(self):
+        ret = []
+        prefixes = set(self.irc.prefix.values())
+        for n in self.get_params()[3].split():
+            i = 0
+            while i < len(n) and n[i] in prefixes:
+                i += 1
+            prefix = parse_prefix(n[i:])
+            host = None
+            if "user" in prefix:
+                host = (prefix["user"], prefix["host"])
+            ret.append((prefix["nickname"], list(n[:i]), host))
+        return ret
 
+
+class RPL_ISUPPORT_005(Base):
+    def __init__(self, m):
+        super().__init__(m)
+
+    def get_tokens(self):
+        """Get the advertised features as {"NAME": value}. Tokens without
+        a value have the value "". Negated tokens (-NAME) have the value
+        None and mean the feature should be reset to its default.
+        """
+        ret = {}
+        # The first parameter is the client and the last is the
+        # human readable "are supported by this server".
+        for token in self.get_params()[1:-1]:
+            if token[:1] == "-":
+                ret[token[1:]] = None
+                continue
+            name, _, value = token.partition("=")
+            ret[name] = _unescape_isupport(value)
         return ret
 
 
+def _unescape_isupport(value):
+    # Values can contain the escape sequences \x20, \x5C and \x3D
+    if "\\x" not in value:
+        return value
+    return re.sub(r"\\x([0-9A-Fa-f]{2})",
+                  lambda m: chr(int(m.group(1), 16)), value)
+
+
+class RPL_HOSTHIDDEN_396(Base):
+    def __init__(self, m):
+        super().__init__(m)
+
+    def get_host(self):
+        # Some servers send "user@host" when the user part changes too
+        return self.get_params()[1].rsplit("@", 1)[-1]
+
+    def get_user(self):
+        s = self.get_params()[1].rsplit("@", 1)
+        return s[0] if len(s) == 2 else None
+
+
 class RPL_ENDOFNAMES_366(Base):
     def __init__(self, m):
         super().__init__(m)
@@ -360,9 +496,14 @@ class RPL_ENDOFNAMES_366(Base):
 # ====================================================================
 
 dispatch = {
+    "001": lambda irc, m: RPL_WELCOME_001(m),
+    "005": lambda irc, m: RPL_ISUPPORT_005(m),
+    "352": lambda irc, m: RPL_WHOREPLY_352(m),
     "353": lambda irc, m: RPL_NAMREPLY_353(irc, m),
     "366": lambda irc, m: RPL_ENDOFNAMES_366(m),
+    "396": lambda irc, m: RPL_HOSTHIDDEN_396(m),
     "CAP": lambda irc, m: Cap(m),
+    "CHGHOST": lambda irc, m: CHGHOST(m),
     "JOIN": lambda irc, m: JOIN(m),
     "MODE": lambda irc, m: MODE(irc, m),
     "NICK": lambda irc, m: NICK(m),
@@ -370,13 +511,16 @@ dispatch = {
     "PART": lambda irc, m: PART(m),
     "KICK": lambda irc, m: KICK(m),
     "PING": lambda irc, m: PING(m),
+    "PONG": lambda irc, m: PONG(m),
     "PRIVMSG": lambda irc, m: PRIVMSG(irc, m),
 }
 
 
 def parse(irc, message):
     m = parse1(message)
-    return dispatch.get(m["command"], lambda irc, m: Base(m))(irc, m)
+    msg = dispatch.get(m["command"], lambda irc, m: Base(m))(irc, m)
+    msg.casemap = irc.casemapping
+    return msg
 
 
 def parse1(message):
@@ -420,13 +564,17 @@ def parse_prefix(prefix):
 
 
 def parse_params(params):
-    p = params.split(":", 1)
+    # The trailing parameter starts at the first " :". A ":" anywhere
+    # else is part of a middle parameter (e.g. TARGMAX=NAMES:1).
+    if params[:1] == ":":
+        return [params[1:]]
+    p = params.split(" :", 1)
     if len(p) == 2:
         params = p[0].split(" ", 14)
         if len(params) == 15:
             params[-1] = params[-1] + " :" + p[1]
             return params
-        params[-1] = p[1]
+        params.append(p[1])
         return params
 
     # Edge case: 14 middle and no space trailing
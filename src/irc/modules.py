@@ -21,26 +21,35 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
+import os
 import sys
+import json
+import time
 import importlib
 import traceback
-import inspect
+import threading
 import collections
-import sqlite3
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
 
 from dbot_tools import Logger
+from irc.database import DiskDatabase, MemoryDatabase, ModuleDatabase
 
 
 # Constants. Initialized with the module.
 irc_command_tpool = ThreadPoolExecutor()
+# Runs the calls of isolated and degraded modules, so that they cannot
+# occupy the threads of irc_command_tpool.
+isolated_tpool = ThreadPoolExecutor(max_workers=4)
 
 # Variables. They are to be initialized by init once.
 log = None
 var_memory = None
 db_memory = None
-db_disk_path = None
+db_disk = None
+stats = None
+supervisor = None
+scheduler = None
 
 
 # ====================================================================
@@ -49,16 +58,58 @@ db_disk_path = None
 
 def init(bot):
     global log
-    log = Logger(bot["loglevel"], Path(bot["logdir"], "modules.log"))
+    log = Logger(bot["loglevel"], Path(bot["logdir"], "modules.log"),
+                 bot["logformat"])
 
     global var_memory
     var_memory = VariableMemory()
 
-    global db_memory
-    db_memory = sqlite3.connect(':memory:', check_same_thread=False)
+    global scheduler
+    scheduler = bot["scheduler"]
 
-    global db_disk_path
-    db_disk_path = f"{bot['botdir']}/drastikbot.db"
+    global db_memory
+    db_memory = MemoryDatabase(
+        snapshot_path=Path(bot["botdir"], "db_memory.db"))
+    interval = bot["conf"].get_memory_snapshot_interval()
+    if interval:
+        try:
+            if db_memory.restore():
+                log.info("- Restored the in-memory database snapshot.")
+        except Exception:
+            tc = traceback.format_exc()
+            log.debug(f"- Restoring the in-memory database failed:\n{tc}")
+        scheduler.every(interval, db_memory.snapshot,
+                        name="db_memory snapshot", connected=False)
+
+    global db_disk
+    db_disk = DiskDatabase(f"{bot['botdir']}/drastikbot.db",
+                           bot["conf"].get_commit_interval())
+
+    global stats
+    stats = ModuleStats(Path(bot["botdir"], "module_stats.json"))
+    scheduler.every(stats.dump_interval, stats.dump, name="module stats",
+                    connected=False)
+
+    global supervisor
+    supervisor = Supervisor()
+
+
+def shutdown(bot):
+    """Save what should survive a restart. Called when the bot quits."""
+    scheduler.stop()
+    if aio_loop is not None:
+        aio_loop.stop()
+    if process_pool is not None:
+        process_pool.shutdown(wait=False)
+    stats.dump()
+    db_disk.close()  # Commits the pending writes
+    if bot["conf"].get_memory_snapshot_interval():
+        try:
+            db_memory.snapshot()
+        except Exception:
+            tc = traceback.format_exc()
+            log.debug(f"- In-memory database snapshot failed:\n{tc}")
+    db_memory.close()
 
 
 # ====================================================================
@@ -68,23 +119,20 @@ def init(bot):
 def _new_module_state():
     return {
         "modules_d": {},  # {module_object: module_path}
+        "names_d": {},  # {module_name: module_object}
         "startup_l": [],  # [module_object]
         "irc_command_d": {},  # {irc_command: [module_object]}
-        "bot_command_d": {}  # {bot_command: [module_object]}
+        "bot_command_d": {},  # {bot_command: [module_object]}
+        "import_times": {}  # {module_name: seconds}
     }
 
 
 def get_object_from_name(s, module_name):
-    for module_object, module_path in s["modules_d"].items():
-        if module_path.stem == module_name:
-            return module_object
-    return None
+    return s["names_d"].get(module_name)
 
 
 def is_imported(s, module_name):
-    module_paths = s["modules_d"].values()
-    module_names = [x.stem for x in module_paths]
-    return module_name in module_names
+    return module_name in s["names_d"]
 
 
 # ====================================================================
@@ -118,57 +166,123 @@ def candidates_from_path(bot, path, load="all"):
 
 
 def read_module_class(s, path, module_object):
+    register_module(s, path, module_object)
+    setup_module(path.stem, module_object)
+    return s
+
+
+def register_module(s, path, module_object, stub=None):
+    """Add a module to the module state. If ``stub'' is given, the
+    module takes the place of that LazyModule in the command lists, so
+    that the dispatch order does not change once it is imported.
+    """
+    if stub is not None:
+        s["modules_d"].pop(stub, None)
     s["modules_d"][module_object] = path
+    s["names_d"][path.stem] = module_object
 
     # Module(): Check if the module has such a class
     try:
         module_class = module_object.Module
     except AttributeError:
         log.debug(f"Module() class not found for: ``{path.stem}''")
-        return s
-
-    # Module(): Handle bot_commands
-    for bot_c in getattr(module_class, "bot_commands", []):
-        s["bot_command_d"].setdefault(bot_c, []).append(module_object)
+        module_class = None
 
-    # Module(): Handle irc_commands
-    for irc_c in getattr(module_class, "irc_commands", []):
-        s["irc_command_d"].setdefault(irc_c, []).append(module_object)
+    # Module(): Handle bot_commands and irc_commands
+    _register_commands(s["bot_command_d"], module_object, stub,
+                       getattr(module_class, "bot_commands", []))
+    _register_commands(s["irc_command_d"], module_object, stub,
+                       getattr(module_class, "irc_commands", []))
 
     # Module(): Handle startup
     if getattr(module_class, "startup", False):
         s["startup_l"].append(module_object)
 
-    return s
+
+def _register_commands(command_d, module_object, stub, commands):
+    for command in commands:
+        module_objects = command_d.setdefault(command, [])
+        if stub in module_objects:
+            module_objects[module_objects.index(stub)] = module_object
+        else:
+            module_objects.append(module_object)
+    if stub is not None:
+        # Commands in the manifest that the module does not handle
+        for module_objects in command_d.values():
+            while stub in module_objects:
+                module_objects.remove(stub)
+
+
+def setup_module(module_name, module_object):
+    """Apply the settings of a module's Module() class that are not kept
+    in the module state. This can be slow: it runs the migrations."""
+    module_class = getattr(module_object, "Module", None)
+    if module_class is None:
+        return
+
+    # Module(): Handle the concurrency policy
+    update_policy_executor(module_name, module_class)
+
+    # Module(): Handle the database migrations
+    if getattr(module_class, "migrations", None):
+        migrate(module_name, module_class.migrations)
+
+
+def _timed_import(path):
+    start = time.perf_counter()
+    try:
+        module_object = importlib.import_module(str(path.stem))
+        tc = None
+    except Exception:
+        module_object = None
+        tc = traceback.format_exc()
+    return module_object, time.perf_counter() - start, tc
 
 
-def import_from_list(modules, log_import=True, state=None):
-    """Imports every module in ``modules'' and returns the mod_state"""
+def import_from_list(modules, log_import=True, state=None, workers=1,
+                     invalidate=True):
+    """Imports every module in ``modules'' and returns the mod_state.
+
+    With ``workers'' > 1 the modules are imported concurrently. They are
+    registered in the order of ``modules'' either way, so that the order
+    of the module calls does not depend on the import times.
+    """
     if state is None:
         s = _new_module_state()
     else:
         s = state
 
-    importlib.invalidate_caches()
+    if invalidate:
+        importlib.invalidate_caches()
 
+    paths = []
+    seen = set()  # Names in this batch, imported after the loop
     for path in modules:
-        if is_imported(s, path.stem):
+        if is_imported(s, path.stem) or path.stem in seen:
             m = (f"! A module called ``{path.stem}'' has already been loaded."
                  " Skipping...")
             log.debug(m)
             continue
+        seen.add(path.stem)
+        paths.append(path)
 
-        try:
-            module_object = importlib.import_module(str(path.stem))
-        except Exception:
-            tc = traceback.format_exc()
+    if workers > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as tpool:
+            results = list(tpool.map(_timed_import, paths))
+    else:
+        results = map(_timed_import, paths)
+
+    for path, (module_object, elapsed, tc) in zip(paths, results):
+        s["import_times"][path.stem] = elapsed
+        if tc is not None:
             log.debug(f"- Module load exception:``{path}''\n{tc}")
             continue
 
         s = read_module_class(s, path, module_object)
 
         if log_import:
-            log.info(f"| Loaded module: {path.stem}")
+            log.info(f"| Loaded module: {path.stem}"
+                     f" ({elapsed * 1000:.1f}ms)")
 
     print("")  # Pretty stdout
 
@@ -181,6 +295,9 @@ def reload_all(bot):
 
     for module_object in old_modules_d:
         path = old_modules_d[module_object]
+        if isinstance(module_object, LazyModule):
+            register_lazy(s, module_object)  # Not imported yet
+            continue
         try:
             importlib.reload(module_object)
         except Exception:
@@ -192,6 +309,7 @@ def reload_all(bot):
             tc = traceback.format_exc()
             log.debug(f"- Module load exception:``{path}''\n{tc}")
             s["modules_d"][module_object] = path
+            s["names_d"][path.stem] = module_object
             continue
 
         read_module_class(s, path, module_object)
@@ -199,28 +317,267 @@ def reload_all(bot):
     return s
 
 
-def mod_import(bot):
+def discover(bot):
+    """Find the modules to import in every module directory.
+
+    :returns: A tuple of three lists: the paths of the core modules, the
+              paths of the third party modules and the LazyModule of the
+              third party modules that are in a manifest.
+    """
     # System modules: Required core modules
     path = Path(bot["program_path"], "irc/modules")
-    import_l = candidates_from_path(bot, path, load="all")
-    s = import_from_list(import_l, log_import=bot["devmode"])
+    core = sorted(candidates_from_path(bot, path, load="all"))
 
     # User modules: Third party modules provided by the user
+    user = []
+    lazy = []
+    lazy_names = set()
     for path, load in bot["conf"].get_modules_paths().items():
         path = Path(path).expanduser()
-        import_l = candidates_from_path(bot, path, load=load)
-        s = import_from_list(import_l, state=s)
+        manifest = read_manifest(path)
+        for module_path in sorted(candidates_from_path(bot, path, load)):
+            if module_path.stem in lazy_names:
+                continue  # The first directory wins, see import_from_list
+            entry = manifest.get(module_path.stem)
+            if entry is None or entry.get("startup", False):
+                user.append(module_path)
+            else:
+                lazy.append(LazyModule(module_path, entry))
+                lazy_names.add(module_path.stem)
+
+    return core, user, lazy
+
+
+def mod_import(bot):
+    start = time.perf_counter()
+    core, user, lazy = discover(bot)
+    importlib.invalidate_caches()
 
+    # The core modules are imported one by one, since other modules
+    # import them (e.g. user_auth). The third party modules are
+    # imported concurrently.
+    s = import_from_list(core, log_import=bot["devmode"], invalidate=False)
+    s = import_from_list(user, state=s, invalidate=False,
+                         workers=bot["conf"].get_module_import_workers())
+
+    for stub in lazy:
+        if not is_imported(s, stub.path.stem):
+            register_lazy(s, stub)
+
+    log_import_profile(s, time.perf_counter() - start)
     return s
 
 
+def log_import_profile(s, elapsed):
+    times = s["import_times"]
+    slowest = sorted(times.items(), key=lambda x: x[1], reverse=True)
+    top = ", ".join(f"{n} {t * 1000:.0f}ms" for n, t in slowest[:5])
+    lazy = sum(isinstance(m, LazyModule) for m in s["modules_d"])
+    log.info(f"- Imported {len(times)} modules in {elapsed * 1000:.0f}ms"
+             f" ({lazy} deferred). Slowest: {top}")
+    log.debug("- Module import times (ms): " + ", ".join(
+        f"{n} {t * 1000:.1f}" for n, t in slowest))
+
+
+# ====================================================================
+# Lazy modules: imported on their first use
+# ====================================================================
+
+# A module directory can list modules in a ``manifest.json'' file with
+# the commands they handle:
+#
+#   {
+#       "weather": {"bot_commands": ["weather", "w"]},
+#       "logger": {"irc_commands": ["PRIVMSG", "JOIN"]}
+#   }
+#
+# These modules are not imported at startup. A LazyModule is registered
+# for their commands instead and the module is imported the first time
+# one of them is dispatched. Modules with "startup": true are imported
+# at startup like every other module.
+
+# The import runs in ``lazy_tpool'' and not in the receive loop, which
+# would stop reading from the server until it is done. The messages
+# dispatched to the module meanwhile wait in the pool, whose single
+# thread submits them in order once it is imported. The LazyModule is
+# replaced by the module in the receive loop, by settle_lazy(), after
+# the pool submitted every message it had for it.
+
+lazy_lock = threading.Lock()
+lazy_tpool = ThreadPoolExecutor(max_workers=1)
+
+
+class LazyModule:
+    """Stands in for a module in the module state until it is imported.
+    """
+    def __init__(self, path, entry):
+        self.path = path
+        self.bot_commands = entry.get("bot_commands", [])
+        self.irc_commands = entry.get("irc_commands", [])
+
+        # Set by the lazy_tpool thread. Use lazy_lock.
+        self.module = None  # The module, once imported
+        self.failed = False  # The import failed
+        self.elapsed = 0.0  # Import time
+        self.pending = 0  # Messages in lazy_tpool
+
+    def __repr__(self):
+        return f"<lazy module '{self.path.stem}' from '{self.path}'>"
+
+
+def read_manifest(path):
+    """Read the manifest.json of a module directory, if there is one."""
+    manifest = Path(path, "manifest.json")
+    if not manifest.is_file():
+        return {}
+    try:
+        with open(manifest) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        tc = traceback.format_exc()
+        log.debug(f"- Unable to read the module manifest ``{manifest}'':"
+                  f"\n{tc}")
+        return {}
+
+
+def register_lazy(s, stub):
+    s["modules_d"][stub] = stub.path
+    s["names_d"][stub.path.stem] = stub
+    for bot_c in stub.bot_commands:
+        s["bot_command_d"].setdefault(bot_c, []).append(stub)
+    for irc_c in stub.irc_commands:
+        s["irc_command_d"].setdefault(irc_c, []).append(stub)
+
+
+def unregister_lazy(s, stub):
+    s["modules_d"].pop(stub, None)
+    s["names_d"].pop(stub.path.stem, None)
+    for d in (s["bot_command_d"], s["irc_command_d"]):
+        for module_objects in d.values():
+            while stub in module_objects:
+                module_objects.remove(stub)
+
+
+def settle_lazy(s, stub):
+    """Called by the dispatchers for a LazyModule. Returns the module if
+    it was imported and can be called directly, the LazyModule if the
+    message should go through lazy_submit() or None if the import
+    failed.
+    """
+    with lazy_lock:
+        if stub.pending:
+            return stub  # Keep the order of the messages in the pool
+        if stub.failed:
+            unregister_lazy(s, stub)
+            return None
+        if stub.module is None:
+            return stub
+
+    register_module(s, stub.path, stub.module, stub)
+    s["import_times"][stub.path.stem] = stub.elapsed
+    return stub.module
+
+
+def lazy_submit(bot, irc, stub, msg, command=None):
+    with lazy_lock:
+        stub.pending += 1
+    lazy_tpool.submit(lazy_task, bot, irc, stub, msg, command)
+
+
+def lazy_task(bot, irc, stub, msg, command):
+    try:
+        if stub.module is None and not stub.failed:
+            load_lazy(stub)
+        if stub.module is not None:
+            module_submit(bot, irc, stub.path.stem, stub.module, msg,
+                          command=command)
+    except Exception:
+        tc = traceback.format_exc()
+        log.debug(f"- Lazy module ``{stub.path.stem}'' error:\n{tc}")
+    finally:
+        with lazy_lock:
+            stub.pending -= 1
+
+
+def load_lazy(stub):
+    name = stub.path.stem
+    module, elapsed, tc = _timed_import(stub.path)
+    if tc is not None:
+        log.debug(f"- Module load exception:``{stub.path}''\n{tc}")
+        with lazy_lock:
+            stub.failed = True
+        return
+
+    setup_module(name, module)
+    with lazy_lock:
+        stub.elapsed = elapsed
+        stub.module = module
+    log.info(f"| Loaded module on first use: {name}"
+             f" ({elapsed * 1000:.1f}ms)")
+
+
+# ====================================================================
+# Database migrations
+# ====================================================================
+
+# Modules declare the schema of their tables in the disk database as a
+# list of migrations in ``Module.migrations''. Each one is either an SQL
+# script or a function that takes the sqlite3 connection. The number of
+# migrations applied to every module is kept in the ``schema_version''
+# table, so only the new ones run when the module is imported and the
+# modules do not have to check the schema when they are called.
+#
+#   class Module:
+#       migrations = [
+#           "CREATE TABLE foo (a TEXT);",            # Version 1
+#           "ALTER TABLE foo ADD COLUMN b INTEGER;"  # Version 2
+#       ]
+
+def migrate(module_name, migrations):
+    db_disk.run(_migrate, module_name, migrations)
+
+
+def _migrate(db, module_name, migrations):
+    db.commit()  # The pending writes of the modules
+    db.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+               " module TEXT PRIMARY KEY,"
+               " version INTEGER NOT NULL);")
+    row = db.execute("SELECT version FROM schema_version WHERE module = ?;",
+                     (module_name,)).fetchone()
+    version = row[0] if row else 0
+
+    for n, migration in enumerate(migrations[version:], version + 1):
+        try:
+            if callable(migration):
+                migration(db)
+            else:
+                # BEGIN, so that the script is applied whole or not at all
+                db.executescript(f"BEGIN;\n{migration}")
+            db.execute("INSERT OR REPLACE INTO schema_version"
+                       " VALUES (?, ?);", (module_name, n))
+            db.commit()
+        except Exception:
+            db.rollback()
+            tc = traceback.format_exc()
+            log.debug(f"- Migration {n} of ``{module_name}'' failed:\n{tc}")
+            log.info(f"- Database migration {n} of ``{module_name}''"
+                     " failed. See the debug log.")
+            return
+        log.debug(f"- Migrated ``{module_name}'' to version {n}.")
+
+
 # ====================================================================
 # Message dispatchers
 # ====================================================================
 
+# ``cancel'' is a threading.Event that is set when the call exceeds its
+# time budget. Long running modules should check it and return early.
+# ``scheduler'' is the irc.scheduler.Scheduler for timed and periodic
+# work.
 CallbackData = collections.namedtuple(
     "CallbackData", [
-        "msg", "db_memory", "db_disk", "bot", "varget", "varset"
+        "msg", "db_memory", "db_disk", "bot", "varget", "varset", "cancel",
+        "scheduler"
     ]
 )
 
@@ -228,41 +585,333 @@ CallbackData = collections.namedtuple(
 def callback_data(bot, msg):
     return CallbackData(
         msg=msg,
-        db_memory=db_memory,
-        db_disk=sqlite3.connect(db_disk_path, check_same_thread=False),
+        db_memory=ModuleDatabase(db_memory),
+        db_disk=ModuleDatabase(db_disk),
         varget=var_memory.varget,
         varset=var_memory.varset,
-        bot=bot
+        bot=bot,
+        cancel=threading.Event(),
+        scheduler=scheduler
     )
 
 
-def mod_call(module_name, fn, data, irc):
+def module_timeout(bot, module_name, module_object):
+    """Get the time budget of a module's calls in seconds.
+
+    The budget is read from the module's settings in the configuration
+    file ("timeout"), then from the ``timeout'' attribute of its Module()
+    class and finally from the global "irc.modules.timeout" setting.
+    A budget of 0 disables the timeout.
+    """
+    settings = bot["conf"].get_module_settings(module_name)
+    if "timeout" in settings:
+        return settings["timeout"]
+    module_class = getattr(module_object, "Module", None)
+    if hasattr(module_class, "timeout"):
+        return module_class.timeout
+    return bot["conf"].get_module_timeout()
+
+
+def in_process(bot, module_name, module_object):
+    settings = bot["conf"].get_module_settings(module_name)
+    if "process" in settings:
+        return settings["process"]
+    module_class = getattr(module_object, "Module", None)
+    return getattr(module_class, "process", False)
+
+
+def is_isolated(bot, module_name, module_object):
+    settings = bot["conf"].get_module_settings(module_name)
+    if "isolated" in settings:
+        return settings["isolated"]
+    module_class = getattr(module_object, "Module", None)
+    return getattr(module_class, "isolated", False)
+
+
+def module_executor(bot, module_name, module_object):
+    """Get the executor that should run a module's calls. Isolated
+    modules and modules that exceeded their time budget are run in
+    their own pool.
+    """
+    if supervisor.is_degraded(module_name) \
+       or is_isolated(bot, module_name, module_object):
+        return isolated_tpool
+    return irc_command_tpool
+
+
+def module_submit(bot, irc, module_name, module_object, msg, command=None):
+    timeout = module_timeout(bot, module_name, module_object)
+    if is_async(module_object.main):
+        async_submit(bot, irc, module_name, module_object.main, msg,
+                     command=command, timeout=timeout)
+        return
+    if in_process(bot, module_name, module_object):
+        process_submit(bot, irc, module_name, msg, command=command)
+        return
+
+    executor = module_executor(bot, module_name, module_object)
+    args = (module_task, bot, irc, module_name, module_object.main, msg)
+    kwargs = {"command": command, "timeout": timeout}
+
+    policy = policy_executors.get(module_name)
+    if policy is None:
+        executor.submit(*args, **kwargs)
+    else:
+        policy.submit(policy.get_key(msg), executor, *args, **kwargs)
+
+
+def module_task(bot, irc, module_name, fn, msg, command=None, timeout=0):
+    # The callback data is made here so that the database connection is
+    # opened by the thread that uses it and not by the receive loop.
+    data = callback_data(bot, msg)
+    mod_call(module_name, fn, data, irc, command=command, timeout=timeout)
+
+
+def mod_call(module_name, fn, data, irc, command=None, timeout=0):
+    """Call a module's entry point and record how long it took.
+
+    :param command: The name the call is recorded under in the module
+                    statistics. Defaults to the IRC command of the message.
+    :param timeout: The time budget of the call in seconds. Calls that
+                    exceed it are cancelled (see Supervisor). 0 disables it.
+    """
+    if command is None:
+        command = data.msg.get_command()
+
+    token = supervisor.begin(module_name, command, timeout, data.cancel)
+    error = False
+    wall = time.perf_counter()
+    cpu = time.thread_time()
     try:
         fn(data, irc)
     except Exception as e:
+        error = True
         tc = traceback.format_exc()
         log.debug(f"Module ``{module_name}'' error: {e}"
                   f"\nMessage: {data.msg.get_message()}"
-                  f"\n{tc}")
+                  f"\n{tc}",
+                  module=module_name, command=command)
+    finally:
+        # Also for BaseException (e.g. SystemExit), or the supervisor
+        # keeps watching the call.
+        supervisor.end(token)
+    cpu = time.thread_time() - cpu
+    wall = time.perf_counter() - wall
+
+    threshold = data.bot["conf"].get_module_slow_threshold()
+    slow = wall > threshold
+    if slow:
+        log.info(f"! Slow handler: ``{module_name}'' took {wall:.3f}s"
+                 f" ({cpu:.3f}s CPU) for {command}",
+                 module=module_name, command=command, latency=wall)
+
+    stats.record(module_name, command, wall, cpu, slow, error)
+
+
+# ====================================================================
+# Async modules: main() is a coroutine function
+# ====================================================================
+
+# Async modules run on a shared asyncio event loop (see irc.aio) instead
+# of the thread pools. Their ``irc'' argument is an irc.aio.AsyncIRC and
+# the databases of their callback data are irc.aio.AsyncDatabase, so
+# that sending and database access are awaited. A call that exceeds its
+# time budget is cancelled and its module is marked as degraded in the
+# Supervisor. The concurrency policies and ``isolated'' do not apply to
+# them.
+
+CO_COROUTINE = 0x80  # inspect.CO_COROUTINE, inspect is slow to import
+
+aio_loop = None  # irc.aio.EventLoop, started for the first async call
+aio_lock = threading.Lock()
+
+
+def is_async(fn):
+    code = getattr(fn, "__code__", None)
+    return code is not None and bool(code.co_flags & CO_COROUTINE)
+
+
+def get_aio_loop():
+    # irc.aio imports asyncio, which is only needed for async modules.
+    global aio_loop
+    with aio_lock:
+        if aio_loop is None:
+            import irc.aio
+            aio_loop = irc.aio.EventLoop()
+        return aio_loop
+
+
+def async_call(bot, irc, fn, msg, timeout=0, cancel=None):
+    """Schedule fn(data, irc) on the event loop and return its
+    concurrent.futures.Future and the callback data."""
+    import irc.aio as aio
+    loop = get_aio_loop()
+    data = callback_data(bot, msg)._replace(
+        db_memory=aio.AsyncDatabase(db_memory),
+        db_disk=aio.AsyncDatabase(db_disk))
+    if cancel is not None:
+        data = data._replace(cancel=cancel)
+    airc = aio.AsyncIRC(irc, loop.out_executor)
+    return loop.call(fn, data, airc, timeout), data
+
+
+def async_submit(bot, irc, module_name, fn, msg, command=None, timeout=0):
+    if command is None:
+        command = msg.get_command()
+    wall = time.perf_counter()
+    future, data = async_call(bot, irc, fn, msg, timeout)
+    # The event loop enforces the budget, the supervisor only tracks the
+    # call for the degraded state.
+    token = supervisor.begin(module_name, command, 0, data.cancel)
+
+    def done(future):
+        import irc.aio as aio
+        elapsed = time.perf_counter() - wall
+        e = None
+        if future.cancelled():
+            # The event loop was stopped, future.exception() would raise
+            error = True
+            log.debug(f"Module ``{module_name}'' call was cancelled."
+                      f"\nMessage: {msg.get_message()}",
+                      module=module_name, command=command)
+        else:
+            e = future.exception()
+            error = e is not None
+        if e is not None:
+            tc = "".join(traceback.format_exception(type(e), e,
+                                                    e.__traceback__))
+            log.debug(f"Module ``{module_name}'' error: {e}"
+                      f"\nMessage: {msg.get_message()}"
+                      f"\n{tc}",
+                      module=module_name, command=command)
+            if isinstance(e, aio.BudgetExceeded):
+                supervisor.degrade(module_name, command)
+        supervisor.end(token)
+
+        threshold = bot["conf"].get_module_slow_threshold()
+        slow = elapsed > threshold
+        if slow:
+            log.info(f"! Slow handler: ``{module_name}'' took"
+                     f" {elapsed:.3f}s for {command}",
+                     module=module_name, command=command, latency=elapsed)
+
+        # The CPU time of a coroutine is not known, it is recorded as 0.
+        stats.record(module_name, command, elapsed, 0.0, slow, error)
+
+    future.add_done_callback(done)
+
+
+# ====================================================================
+# Process modules: run in a pool of worker processes
+# ====================================================================
+
+# Modules with ``process = True'' in their Module() class, or "process"
+# in their settings, are called in a worker process (see irc.procpool),
+# so that CPU bound work does not hold the GIL of the bot. The module is
+# imported again in every worker and gets a copy of the message and of
+# the state of ``irc'', without the roster. What it sends through
+# irc.send and irc.out is sent by the bot when the call returns. The
+# databases, the scheduler and the bot state other than the
+# configuration are not available and varget/varset only keep values in
+# the worker process. The time budget is not enforced.
+
+process_pool = None  # concurrent.futures.ProcessPoolExecutor
+process_lock = threading.Lock()
+
+
+def get_process_pool(bot):
+    global process_pool
+    with process_lock:
+        if process_pool is None:
+            import irc.procpool
+            workers = bot["conf"].get_module_processes() or os.cpu_count()
+            process_pool = irc.procpool.new_pool(workers)
+        return process_pool
+
+
+def reset_process_pool(pool):
+    """A worker died and ``pool'' can not be used again. The next call
+    makes a new one."""
+    global process_pool
+    with process_lock:
+        if process_pool is pool:
+            process_pool = None
+            log.info("! A module worker process died. Restarting them.")
+    pool.shutdown(wait=False)
+
+
+def process_submit(bot, irc, module_name, msg, command=None):
+    import irc.procpool as procpool
+    if command is None:
+        command = msg.get_command()
+
+    irc_slice = procpool.IRCSlice(irc)
+    bot_slice = {k: bot[k] for k in ("program_path", "botdir", "conf",
+                                     "devmode")}
+    wall = time.perf_counter()
+    pool = get_process_pool(bot)
+    future = pool.submit(
+        procpool.run_module, module_name,
+        procpool.picklable_msg(msg, irc_slice), bot_slice, irc_slice)
+
+    def done(future):
+        elapsed = time.perf_counter() - wall
+        try:
+            calls, tc, cpu = future.result()
+        except Exception as e:
+            calls, tc, cpu = [], traceback.format_exc(), 0.0
+            if isinstance(e, BrokenExecutor):
+                reset_process_pool(pool)
+        error = tc is not None
+        if error:
+            log.debug(f"Module ``{module_name}'' error:"
+                      f"\nMessage: {msg.get_message()}"
+                      f"\n{tc}",
+                      module=module_name, command=command)
+        if calls:
+            # irc.send may sleep, do not block the pool's thread.
+            irc_command_tpool.submit(procpool.replay, irc, calls)
+
+        threshold = bot["conf"].get_module_slow_threshold()
+        slow = elapsed > threshold
+        if slow:
+            log.info(f"! Slow handler: ``{module_name}'' took"
+                     f" {elapsed:.3f}s ({cpu:.3f}s CPU) for {command}",
+                     module=module_name, command=command, latency=elapsed)
+
+        stats.record(module_name, command, elapsed, cpu, slow, error)
+
+    future.add_done_callback(done)
 
 
 def bot_command_dispatch(s, bot, irc, msg):
     conf = bot["conf"]
-    data = callback_data(bot, msg)
     channel = msg.get_msgtarget()
 
-    for module_object in s["bot_command_d"].get(msg.get_botcmd(), []):
+    # A copy: settle_lazy() changes the list when a lazy module is ready
+    for module_object in list(s["bot_command_d"].get(msg.get_botcmd(), [])):
         module_name = s["modules_d"][module_object].stem
 
         # Is the channel blacklisted/whitelisted ?
-        if not conf.check_channel_module_access(module_name, channel):
+        if not conf.check_channel_module_access(module_name, channel,
+                                                msg.casemap):
             continue
 
         # Is the user restricted by the user access list ?
         if conf.is_banned_user_access_list(msg, module_name):
             continue
 
-        mod_call(module_name, module_object.main, data, irc)
+        if isinstance(module_object, LazyModule):
+            module_object = settle_lazy(s, module_object)
+            if module_object is None:
+                continue
+            if isinstance(module_object, LazyModule):
+                lazy_submit(bot, irc, module_object, msg,
+                            command=msg.get_botcmd())
+                continue
+
+        module_submit(bot, irc, module_name, module_object, msg,
+                      command=msg.get_botcmd())
 
 
 def bot_command_maybe(s, bot, irc, msg):
@@ -279,28 +928,48 @@ def bot_command_maybe(s, bot, irc, msg):
 def irc_command_dispatch(s, bot, irc, msg):
     conf = bot["conf"]
 
-    for module_object in s["irc_command_d"].get(msg.get_command(), []):
+    for module_object in list(s["irc_command_d"].get(msg.get_command(),
+                                                     [])):
         module_name = s["modules_d"][module_object].stem
 
         if msg.get_command() == "PRIVMSG":
             channel = msg.get_msgtarget()
 
             # Is the channel blacklisted/whitelisted ?
-            if not conf.check_channel_module_access(module_name, channel):
+            if not conf.check_channel_module_access(module_name, channel,
+                                                    msg.casemap):
                 continue
 
             # Is the user restricted by the user access list ?
             if conf.is_banned_user_access_list(msg, module_name):
                 continue
 
-        data = callback_data(bot, msg)  # Make a new db connection
-        irc_command_tpool.submit(
-            mod_call, module_name, module_object.main, data, irc)
+        if isinstance(module_object, LazyModule):
+            module_object = settle_lazy(s, module_object)
+            if module_object is None:
+                continue
+            if isinstance(module_object, LazyModule):
+                lazy_submit(bot, irc, module_object, msg)
+                continue
+
+        module_submit(bot, irc, module_name, module_object, msg)
 
 
 def dispatch(bot, irc, msg):
+    """Route a message to the modules that handle it.
+
+    This is called by the receive loop for every message in the order
+    they arrive. It only decides which modules to call and queues the
+    calls in their executors, so modules declared ``serial'' (such as
+    events) see the messages in the order the server sent them.
+    """
     s = bot["modules"]
-    irc_command_tpool.submit(irc_command_dispatch, s, bot, irc, msg)
+
+    try:
+        irc_command_dispatch(s, bot, irc, msg)
+    except Exception:
+        tc = traceback.format_exc()
+        log.debug(f"- Module dispatch error:\n{tc}")
 
     try:
         bot_command_maybe(s, bot, irc, msg)
@@ -310,29 +979,524 @@ def dispatch(bot, irc, msg):
 
 
 StartupMsg = collections.namedtuple("StartupMsg", [
-    "get_command", "is_command"])
+    "get_command", "is_command", "get_message"])
+
+startup_msg = StartupMsg(lambda: "__STARTUP", lambda x: x == "__STARTUP",
+                         lambda: "__STARTUP")
+
+startup_tasks = []  # [StartupTask] of the current connection
 
 
 def startup(bot, irc):
     '''
     Run modules configured with the "self.startup = True" option.
-    The bot doesn't manage the modules after they get started.
-    This could be problematic for modules that are blocking and so they
-    should periodically check the bot's connection bot_state (e.g. by checking
-    the value of "irc.conn_bot_state") and handle a possible disconnect.
+
+    Modules that also set "startup_first = True" (registration) are run
+    first, one by one, and the rest are started only after they return.
+    Every other startup module runs in its own thread as a StartupTask,
+    so a blocking module does not delay the others or the registration.
+    The tasks are stopped by stop_startup() when the connection is lost,
+    which calls the module's stop(i, irc) if it has one, and started
+    again for the next one.
     The bot's whitelist/blacklist is not being taken into account.
     '''
     s = bot["modules"]
-    msg = StartupMsg(lambda: "__STARTUP", lambda x: x == "__STARTUP")
-    data = callback_data(bot, msg)
-
+    first = []
+    rest = []
     for module_object in s["startup_l"]:
+        module_class = module_object.Module
+        if getattr(module_class, "startup_first", False):
+            first.append(module_object)
+        else:
+            rest.append(module_object)
+
+    for module_object in first:
+        module_name = s["modules_d"][module_object].stem
+        data = callback_data(bot, startup_msg)
+        mod_call(module_name, module_object.main, data, irc,
+                 command="__STARTUP")
+
+    for module_object in rest:
+        module_name = s["modules_d"][module_object].stem
+        task = StartupTask(bot, irc, module_name, module_object)
+        startup_tasks.append(task)
+        task.start()
+
+
+def stop_startup(timeout=5):
+    """Stop the startup modules of the connection that was lost. Their
+    stop(i, irc) is called, their ``cancel'' event is set and they get
+    ``timeout'' seconds to return.
+    """
+    tasks = startup_tasks[:]
+    del startup_tasks[:]
+    for task in tasks:
+        task.stop()
+    deadline = time.monotonic() + timeout
+    for task in tasks:
+        task.join(max(0, deadline - time.monotonic()))
+        if task.is_alive():
+            log.info(f"! Startup module ``{task.module_name}'' did not"
+                     " stop.", module=task.module_name)
+
+
+class StartupTask:
+    """Run the main() of a startup module in its own thread and restart
+    it if it raises an exception, until the connection is lost.
+
+    The restarts back off exponentially, from ``first_delay'' up to
+    ``max_delay'' seconds. A module that ran for longer than
+    ``max_delay'' before crashing is restarted after ``first_delay''
+    again. A module whose main() returns is not restarted.
+
+    The ``cancel'' event of the callback data is set by stop(). Modules
+    that run for as long as the connection should check it (or
+    irc.conn_state) and return when it is set. A module that blocks on
+    something else, like a socket or a queue, can define
+    ``stop(i, irc)'' next to main(). It is called before the event is
+    set and should unblock main(), e.g. by closing the socket.
+    """
+    first_delay = 1
+    max_delay = 300
+
+    def __init__(self, bot, irc, module_name, module_object):
+        self.bot = bot
+        self.irc = irc
+        self.module_name = module_name
+        self.module_object = module_object
+        self.cancel = threading.Event()
+        self.restarts = 0
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name=f"startup-{module_name}")
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        hook = getattr(self.module_object, "stop", None)
+        if hook is not None:
+            data = callback_data(self.bot, startup_msg)._replace(
+                cancel=self.cancel)
+            try:
+                if is_async(hook):
+                    async_call(self.bot, self.irc, hook, startup_msg,
+                               cancel=self.cancel)[0].result()
+                else:
+                    hook(data, self.irc)
+            except Exception as e:
+                tc = traceback.format_exc()
+                log.debug(f"Module ``{self.module_name}'' stop() error:"
+                          f" {e}\n{tc}",
+                          module=self.module_name, command="__STARTUP")
+        self.cancel.set()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def _run(self):
+        delay = self.first_delay
+        while not self.cancel.is_set() and self.irc.conn_state != 0:
+            started = time.monotonic()
+            if self._call():
+                return  # Returned normally
+
+            if self.cancel.is_set():
+                return
+            if time.monotonic() - started > self.max_delay:
+                delay = self.first_delay  # It was working for a while
+            self.restarts += 1
+            log.info(f"! Startup module ``{self.module_name}'' crashed."
+                     f" Restarting in {delay}s.", module=self.module_name)
+            if self.cancel.wait(delay):
+                return
+            delay = min(self.max_delay, delay * 2)
+
+    def _call(self):
+        """Call the module once. Returns False if it raised."""
+        data = callback_data(self.bot, startup_msg)._replace(
+            cancel=self.cancel)
+        wall = time.perf_counter()
+        cpu = time.thread_time()
         try:
-            module_object.main(data, irc)
-        except Exception:
-            module_name = s["modules_d"][module_object]
+            fn = self.module_object.main
+            if is_async(fn):
+                async_call(self.bot, self.irc, fn, startup_msg,
+                           cancel=self.cancel)[0].result()
+            else:
+                fn(data, self.irc)
+            error = False
+        except Exception as e:
+            error = True
+            tc = traceback.format_exc()
+            log.debug(f"Module ``{self.module_name}'' error: {e}\n{tc}",
+                      module=self.module_name, command="__STARTUP")
+        wall = time.perf_counter() - wall
+        cpu = time.thread_time() - cpu
+        stats.record(self.module_name, "__STARTUP", wall, cpu, False,
+                     error)
+        return not error
+
+
+# ====================================================================
+# Execution policies: per module concurrency limits
+# ====================================================================
+
+# {module_name: PolicyExecutor} Kept between module reloads.
+policy_executors = {}
+
+
+def get_module_policy(module_class):
+    """Read the concurrency policy declared in a module's Module() class:
+
+    max_in_flight = N     : At most N calls of the module run at once.
+                            The rest wait in a queue.
+    serial = True         : Run the calls one at a time in the order the
+                            messages were dispatched.
+    serial = "channel"    : Like above, but with one queue per channel.
+                            Calls for different channels run in parallel.
+    pool = N              : Run the calls in a dedicated pool of N
+                            threads instead of the shared one.
+
+    Returns None if the module does not declare a policy.
+    """
+    policy = (getattr(module_class, "max_in_flight", 0),
+              getattr(module_class, "serial", False),
+              getattr(module_class, "pool", 0))
+    if not any(policy):
+        return None
+    return policy
+
+
+def update_policy_executor(module_name, module_class):
+    policy = get_module_policy(module_class)
+    old = policy_executors.get(module_name)
+    if old is not None and old.policy == policy:
+        return  # Keep the executor and its queues
+
+    if old is not None:
+        old.retire()
+        del policy_executors[module_name]
+
+    if policy is not None:
+        policy_executors[module_name] = PolicyExecutor(policy)
+
+
+def _channel_key(msg):
+    if hasattr(msg, "get_msgtarget"):
+        return msg.casemap.key(msg.get_msgtarget())
+    if hasattr(msg, "get_channel"):
+        return msg.casemap.key(msg.get_channel())
+    return None
+
+
+class PolicyExecutor:
+    """Run the calls of a module according to its concurrency policy.
+
+    Calls are queued in the order they are submitted and started when
+    the policy allows it. A started call runs in the module's dedicated
+    pool, or in the executor given to submit() if there is none.
+
+    The queue is keyed by get_key(): None for ``serial = True'', so that
+    every call waits for the previous one, and the channel of the
+    message for ``serial = "channel"''. A waiting call does not hold a
+    thread, it is started by the call before it when that one returns.
+    """
+    def __init__(self, policy):
+        self.policy = policy
+        max_in_flight, serial, pool = policy
+        self.limit = max_in_flight
+        self.serial = serial
+        self.pool = ThreadPoolExecutor(max_workers=pool) if pool else None
+
+        self.lock = threading.Lock()
+        self.pending = collections.deque()  # (key, executor, fn, args, kw)
+        self.busy_keys = set()
+        self.in_flight = 0
+        self.retired = False
+
+    def get_key(self, msg):
+        if self.serial == "channel":
+            return _channel_key(msg)
+        return None
+
+    def submit(self, key, executor, fn, *args, **kwargs):
+        with self.lock:
+            self.pending.append((key, executor, fn, args, kwargs))
+            self._schedule()
+
+    def retire(self):
+        """Stop the dedicated pool after every queued call has run."""
+        with self.lock:
+            self.retired = True
+            self._maybe_shutdown()
+
+    def _schedule(self):
+        # Must be called with self.lock held.
+        skipped = collections.deque()
+        while self.pending:
+            if self.limit and self.in_flight >= self.limit:
+                break
+            task = self.pending.popleft()
+            key = task[0]
+            if self.serial and key in self.busy_keys:
+                skipped.append(task)  # Keep the order of this key
+                continue
+            self.in_flight += 1
+            self.busy_keys.add(key)
+            executor = self.pool or task[1]
+            executor.submit(self._run, *task)
+        skipped.extend(self.pending)
+        self.pending = skipped
+
+    def _run(self, key, executor, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.busy_keys.discard(key)
+                self._schedule()
+                self._maybe_shutdown()
+
+    def _maybe_shutdown(self):
+        # Must be called with self.lock held.
+        if self.retired and self.pool and not self.pending \
+           and not self.in_flight:
+            self.pool.shutdown(wait=False)
+
+
+# ====================================================================
+# Supervisor: enforce the time budget of module calls
+# ====================================================================
+
+class Supervisor:
+    """Watch the module calls in progress and cancel the ones that exceed
+    their time budget.
+
+    Python threads cannot be killed, so cancelling a call means setting
+    its ``cancel'' event and marking the module as degraded. The calls
+    of degraded modules are run in ``isolated_tpool'' until one of them
+    completes within its budget again. This way a module that hangs can
+    only occupy the threads of the isolated pool and not the ones used
+    by the core modules.
+    """
+    interval = 0.5  # seconds between checks
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # {token: [module_name, command, deadline, event]}
+        self.degraded = {}  # {module_name: time.time() of degradation}
+        self.counter = 0
+        self.thread = threading.Thread(target=self._watch, daemon=True)
+        self.thread.start()
+
+    def begin(self, module_name, command, timeout, event):
+        deadline = time.monotonic() + timeout if timeout else None
+        with self.lock:
+            self.counter += 1
+            token = self.counter
+            self.calls[token] = [module_name, command, deadline, event]
+        return token
+
+    def end(self, token):
+        with self.lock:
+            module_name, _, _, event = self.calls.pop(token)
+            if not event.is_set() and module_name in self.degraded:
+                del self.degraded[module_name]
+                recovered = True
+            else:
+                recovered = False
+        if recovered:
+            log.info(f"+ Module ``{module_name}'' recovered.",
+                     module=module_name)
+
+    def is_degraded(self, module_name):
+        return module_name in self.degraded
+
+    def degrade(self, module_name, command):
+        """Mark a module as degraded for a call that exceeded its time
+        budget. Used for the calls whose budget is enforced elsewhere,
+        like those of async modules."""
+        with self.lock:
+            self.degraded.setdefault(module_name, time.time())
+        self._log_expired(module_name, command)
+
+    @staticmethod
+    def _log_expired(module_name, command):
+        log.info(f"! Module ``{module_name}'' exceeded its time"
+                 f" budget for {command}. Marked as degraded.",
+                 module=module_name, command=command)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            expired = []
+            with self.lock:
+                for call in self.calls.values():
+                    module_name, command, deadline, event = call
+                    if deadline is None or deadline > now or event.is_set():
+                        continue
+                    event.set()
+                    self.degraded.setdefault(module_name, time.time())
+                    expired.append((module_name, command))
+
+            for module_name, command in expired:
+                self._log_expired(module_name, command)
+
+
+# ====================================================================
+# Module statistics: per module and per command execution times
+# ====================================================================
+
+class Histogram:
+    """Count samples in exponential buckets. The upper bound of the
+    first bucket is 1ms and every next bucket doubles it. Samples
+    larger than the last bound are counted in an overflow bucket.
+    """
+    bounds = tuple(0.001 * 2 ** n for n in range(17))  # 1ms to ~65s
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+
+    def add(self, value):
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            index = len(self.bounds)
+        self.counts[index] += 1
+        self.total += 1
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket that holds the p-th
+        percentile or None if there are no samples. For the overflow
+        bucket float("inf") is returned.
+        """
+        if not self.total:
+            return None
+        rank = self.total * p / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        if index < len(self.bounds):
+            return self.bounds[index]
+        return float("inf")
+
+    def to_dict(self):
+        labels = [f"<={b * 1000:g}ms" for b in self.bounds] + ["inf"]
+        return {k: v for k, v in zip(labels, self.counts) if v}
+
+
+class StatsEntry:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.slow = 0
+        self.wall_total = 0.0
+        self.wall_max = 0.0
+        self.cpu_total = 0.0
+        self.wall = Histogram()
+        self.cpu = Histogram()
+
+    def record(self, wall, cpu, slow, error):
+        self.calls += 1
+        self.errors += error
+        self.slow += slow
+        self.wall_total += wall
+        self.wall_max = max(self.wall_max, wall)
+        self.cpu_total += cpu
+        self.wall.add(wall)
+        self.cpu.add(cpu)
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.slow += other.slow
+        self.wall_total += other.wall_total
+        self.wall_max = max(self.wall_max, other.wall_max)
+        self.cpu_total += other.cpu_total
+        for h, o in ((self.wall, other.wall), (self.cpu, other.cpu)):
+            h.counts = [x + y for x, y in zip(h.counts, o.counts)]
+            h.total += o.total
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "slow": self.slow,
+            "wall_total": self.wall_total,
+            "wall_max": self.wall_max,
+            "wall_p50": self.wall.percentile(50),
+            "wall_p95": self.wall.percentile(95),
+            "cpu_total": self.cpu_total,
+            "wall_histogram": self.wall.to_dict(),
+            "cpu_histogram": self.cpu.to_dict()
+        }
+
+
+class ModuleStats:
+    """Keep execution time statistics for every (module, command) pair
+    called by mod_call(). They are written to ``path'' as JSON, along
+    with the metrics of the scheduled jobs, every ``dump_interval''
+    seconds by a scheduler job.
+    """
+    dump_interval = 60  # seconds
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}  # {(module_name, command): StatsEntry}
+
+    def record(self, module_name, command, wall, cpu, slow, error):
+        with self.lock:
+            key = (module_name, command)
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = StatsEntry()
+            entry.record(wall, cpu, slow, error)
+
+    def by_module(self):
+        """Return {module_name: StatsEntry} with the commands merged."""
+        ret = {}
+        with self.lock:
+            for (module_name, _), entry in self.entries.items():
+                ret.setdefault(module_name, StatsEntry()).merge(entry)
+        return ret
+
+    def by_command(self, module_name):
+        """Return {command: StatsEntry} for a single module."""
+        ret = {}
+        with self.lock:
+            for (name, command), entry in self.entries.items():
+                if name == module_name:
+                    ret.setdefault(command, StatsEntry()).merge(entry)
+        return ret
+
+    def to_dict(self):
+        ret = {}
+        with self.lock:
+            for (module_name, command), entry in self.entries.items():
+                ret.setdefault(module_name, {})[command] = entry.to_dict()
+        return ret
+
+    def dump(self):
+        data = {"time": time.time(), "modules": self.to_dict(),
+                "jobs": scheduler.to_dict()}
+        tmp = self.path.with_suffix(".tmp")
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=4)
+            os.replace(tmp, self.path)
+        except OSError:
             tc = traceback.format_exc()
-            log.debug(f"- Module ``{module_name}'' error:\n{tc}")
+            log.debug(f"- Unable to write the module statistics:\n{tc}")
 
 
 # ====================================================================
@@ -353,8 +1517,7 @@ class VariableMemory:
         those variables easier.
         """
         # Get the caller module's name:
-        frm = inspect.stack()[1]
-        mod = inspect.getmodule(frm[0]).__name__
+        mod = sys._getframe(1).f_globals["__name__"]
         # Check if it's a call from this module. (modules.py)
         if mod == __loader__.name:
             return
@@ -375,8 +1538,7 @@ class VariableMemory:
         """
         if not raw:
             # Get the caller module's name:
-            frm = inspect.stack()[1]
-            mod = inspect.getmodule(frm[0]).__name__
+            mod = sys._getframe(1).f_globals["__name__"]
             # Check if it's a call from this module. (modules.py)
             if mod == __loader__.name:
                 return
@@ -34,7 +34,7 @@ class Module:
         "mod_import", "mod_reload",
         "mod_whitelist_add", "mod_whitelist_del",
         "mod_blacklist_add", "mod_blacklist_del",
-        "mod_list",
+        "mod_list", "mod_stats",
         "mod_global_prefix_set", "mod_channel_prefix_set",
         "admin_help"
     ]
@@ -56,13 +56,10 @@ def is_bot_owner(irc, nickname):
 
 
 def is_channel_mod(irc, nickname, channel):
-    try:
-        for m in irc.names[channel][nickname]:
-            if m[0] in user_modes:
-                return True
-        return False
-    except Exception:
+    modes = irc.names.get_modes(channel, nickname)
+    if not modes:
         return False
+    return any(m in user_modes for m in modes)
 
 
 def is_allowed(i, irc, nickname, channel=""):
@@ -544,6 +541,49 @@ def mod_list(i, irc):
         irc.out.notice(nickname, m)
 
 
+def _format_stats(name, entry):
+    avg = entry.wall_total / entry.calls * 1000
+    p95 = entry.wall.percentile(95) * 1000
+    return (f"{name}: {entry.calls} calls, avg {avg:.1f}ms,"
+            f" p95 <{p95:g}ms, max {entry.wall_max * 1000:.1f}ms,"
+            f" cpu {entry.cpu_total:.2f}s, {entry.slow} slow,"
+            f" {entry.errors} errors")
+
+
+def mod_stats(i, irc):
+    nickname = i.msg.get_nickname()
+    args = i.msg.get_args().strip()
+    prefix = i.msg.get_botcmd_prefix()
+
+    if len(args.split()) > 1:
+        m = f"Usage: {prefix}mod_stats [module]"
+        return irc.out.notice(nickname, m)
+
+    if not is_allowed(i, irc, nickname):
+        m = f"\x0304You are not authorized. Are you logged in?"
+        return irc.out.notice(nickname, m)
+
+    if args:
+        entries = modmgmt.stats.by_command(args)
+        if not entries:
+            m = f"\x0304No statistics recorded for ``{args}''"
+            return irc.out.notice(nickname, m)
+    else:
+        entries = modmgmt.stats.by_module()
+
+    # Slowest first
+    ranked = sorted(entries.items(), key=lambda x: x[1].wall_total,
+                    reverse=True)
+    for name, entry in ranked[:10]:
+        m = _format_stats(name, entry)
+        if not args and modmgmt.supervisor.is_degraded(name):
+            m += " \x0304(degraded)"
+        irc.out.notice(nickname, m)
+
+    modmgmt.stats.dump()
+    irc.out.notice(nickname, f"Full statistics: {modmgmt.stats.path}")
+
+
 def mod_global_prefix_set(i, irc):
     nickname = i.msg.get_nickname()
     args = i.msg.get_args().strip()
@@ -719,6 +759,14 @@ def admin_help(i, irc):
         " blacklist. Bot owners can omit the <channel argument> and get a list"
         " of all channels that have been in a whitelist or a blacklist."
     ]
+    mod_stats = [
+        f"Usage: {prefix}mod_stats [module]",
+        " Permission: Owners",
+        "Show the modules that used most of the bot's time, slowest first."
+        " If <module> is given, show the time it spent on each command. The"
+        " full statistics are written in module_stats.json in the bot's"
+        " directory."
+    ]
     mod_global_prefix_set = [
         f"Usage: {prefix}mod_global_prefix_set <prefix>",
         " Permission: Owners",
@@ -748,6 +796,7 @@ def admin_help(i, irc):
         "mod_whitelist_del": mod_whitelist_del,
         "mod_blacklist_del": mod_blacklist_del,
         "mod_list": mod_list,
+        "mod_stats": mod_stats,
         "mod_global_prefix_set": mod_global_prefix_set,
         "mod_channel_prefix_set": mod_channel_prefix_set,
         "admin_help": admin_help
@@ -790,6 +839,7 @@ def main(i, irc):
         "mod_whitelist_del": mod_whitelist_del,
         "mod_blacklist_del": mod_blacklist_del,
         "mod_list": mod_list,
+        "mod_stats": mod_stats,
         "mod_global_prefix_set": mod_global_prefix_set,
         "mod_channel_prefix_set": mod_channel_prefix_set,
         "admin_help": admin_help
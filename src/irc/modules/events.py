@@ -3,6 +3,9 @@
 # This is core module for Drastikbot.
 # It handles events such as JOIN, PART, QUIT, NICK, MODE and updates irc.py's
 # variables for use by the other modules.
+# The module is declared serial, so the dispatcher calls it one message at a
+# time in the order they were received. It is the only writer of irc.names
+# and irc.channels, which lets the readers use them without locking.
 
 '''
 Copyright (C) 2018-2019, 2021 drastik.org
@@ -24,25 +27,58 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
 class Module:
-    irc_commands = ["353", "366", "JOIN", "MODE", "NICK", "PART", "KICK",
-                    "QUIT"]
+    irc_commands = ["001", "005", "352", "353", "366", "396", "CHGHOST",
+                    "JOIN", "MODE", "NICK", "PART", "KICK", "QUIT"]
+    serial = True  # The events change irc.names and must apply in order
+
+
+def rpl_welcome_001(i, irc):
+    irc.registered()
+    # The nickname the server registered us with
+    irc.curr_nickname = i.msg.get_nickname()
+    hostmask = i.msg.get_hostmask()
+    if hostmask:
+        irc.set_hostmask(hostmask["user"], hostmask["host"])
+    else:
+        irc.update_msg_len()
+
+
+def rpl_isupport_005(i, irc):
+    irc.apply_isupport(i.msg.get_tokens())
 
 
 def rpl_namreply_353(i, irc):
-    state = i.varget("names", defval={})
-    channel = i.msg.get_channel()
-    if channel not in state or state[channel] == "ended":
-        irc.names[channel] = i.msg.get_names()
-        state[channel] = "pending"
-        i.varset("names", state)
-    else:
-        irc.names[channel].update(i.msg.get_names())
+    hosts = i.msg.get_hosts()  # Only with userhost-in-names
+    irc.names.names_reply(i.msg.get_channel(), i.msg.get_names(), hosts)
+    for nickname, (user, host) in hosts.items():
+        if irc.is_curr_nickname(nickname):
+            irc.set_hostmask(user, host)
 
 
 def rpl_endofnames_366(i, irc):
-    state = i.varget("names", defval={})
-    state[i.msg.get_channel()] = "ended"
-    i.varset("names", state)
+    irc.names.names_end(i.msg.get_channel())
+
+
+# ====================================================================
+# Hostmask
+# ====================================================================
+
+def rpl_whoreply_352(i, irc):
+    if irc.is_curr_nickname(i.msg.get_nickname()):
+        irc.set_hostmask(i.msg.get_user(), i.msg.get_host())
+
+
+def rpl_hosthidden_396(i, irc):
+    irc.set_hostmask(i.msg.get_user(), i.msg.get_host())
+
+
+def chghost(i, irc):
+    nickname = i.msg.get_nickname()
+    user = i.msg.get_new_user()
+    host = i.msg.get_new_host()
+    irc.names.set_host(nickname, user, host)
+    if irc.is_curr_nickname(nickname):
+        irc.set_hostmask(user, host)
 
 
 # ====================================================================
@@ -51,7 +87,7 @@ def rpl_endofnames_366(i, irc):
 
 def join(i, irc):
     nickname = i.msg.get_nickname()
-    if nickname == irc.curr_nickname:
+    if irc.is_curr_nickname(nickname):
         join_bot(i, irc)
     else:
         join_user(i, irc)
@@ -59,7 +95,10 @@ def join(i, irc):
 
 def join_bot(i, irc):
     channel = i.msg.get_channel()
-    irc.channels[channel] = []
+    irc.channels[irc.casemapping(channel)] = []
+    irc.names.add_channel(channel)
+    # The JOIN is relayed with our hostmask as seen by the others.
+    irc.set_hostmask(i.msg.get_user(), i.msg.get_host())
 
     # Log bot JOIN events
     i.bot["runlog"].info(f"+ Joined {channel}")
@@ -68,10 +107,8 @@ def join_bot(i, irc):
 def join_user(i, irc):
     nickname = i.msg.get_nickname()
     channel = i.msg.get_channel()
-    try:
-        irc.names[channel].update({nickname: [""]})
-    except KeyError:
-        irc.names[channel] = {nickname: [""]}
+    irc.names.join(channel, nickname, user=i.msg.get_user(),
+                   host=i.msg.get_host())
 
 
 # ====================================================================
@@ -80,7 +117,7 @@ def join_user(i, irc):
 
 def part(i, irc):
     nickname = i.msg.get_nickname()
-    if nickname == irc.curr_nickname:
+    if irc.is_curr_nickname(nickname):
         part_bot(i, irc)
     else:
         part_user(i, irc)
@@ -88,7 +125,8 @@ def part(i, irc):
 
 def part_bot(i, irc):
     channel = i.msg.get_channel()
-    del irc.channels[channel]
+    irc.channels.pop(irc.casemapping(channel), None)
+    irc.names.remove_channel(channel)
 
     # Log bot PART events
     i.bot["runlog"].info(f"- Left {channel}")
@@ -97,7 +135,7 @@ def part_bot(i, irc):
 def part_user(i, irc):
     nickname = i.msg.get_nickname()
     channel = i.msg.get_channel()
-    del irc.names[channel][nickname]
+    irc.names.part(channel, nickname)
 
 
 # ====================================================================
@@ -106,7 +144,7 @@ def part_user(i, irc):
 
 def kick(i, irc):
     target_user = i.msg.get_target_user()
-    if target_user == irc.curr_nickname:
+    if irc.is_curr_nickname(target_user):
         kick_bot(i, irc)
     else:
         kick_user(i, irc)
@@ -118,7 +156,8 @@ def kick_bot(i, irc):
     host = i.msg.get_host()
     channel = i.msg.get_channel()
     comment = i.msg.get_comment()
-    del irc.channels[channel]
+    irc.channels.pop(irc.casemapping(channel), None)
+    irc.names.remove_channel(channel)
 
     # Log bot KICK events
     m = (f"- Left {channel}"
@@ -129,7 +168,7 @@ def kick_bot(i, irc):
 def kick_user(i, irc):
     nickname = i.msg.get_target_user()
     channel = i.msg.get_channel()
-    del irc.names[channel][nickname]
+    irc.names.part(channel, nickname)
 
 
 # ====================================================================
@@ -137,10 +176,7 @@ def kick_user(i, irc):
 # ====================================================================
 
 def quit(i, irc):
-    nickname = i.msg.get_nickname()
-    for channel in irc.names:
-        if nickname in irc.names[channel]:
-            del irc.names[channel][nickname]
+    irc.names.quit(i.msg.get_nickname())
 
 
 # ====================================================================
@@ -149,7 +185,7 @@ def quit(i, irc):
 
 def nick(i, irc):
     old_nickname = i.msg.get_nickname()
-    if old_nickname == irc.curr_nickname:
+    if irc.is_curr_nickname(old_nickname):
         nick_bot(i, irc)
     else:
         nick_user(i, irc)
@@ -158,15 +194,13 @@ def nick(i, irc):
 def nick_bot(i, irc):
     new_nickname = i.msg.get_new_nickname()
     irc.curr_nickname = new_nickname
+    irc.update_msg_len()
 
 
 def nick_user(i, irc):
     old_nickname = i.msg.get_nickname()
     new_nickname = i.msg.get_new_nickname()
-    for channel in irc.names:
-        if old_nickname in irc.names[channel]:
-            mode = irc.names[channel].pop(old_nickname)
-            irc.names[channel][new_nickname] = mode
+    irc.names.rename(old_nickname, new_nickname)
 
 
 # ====================================================================
@@ -175,38 +209,41 @@ def nick_user(i, irc):
 
 def mode(i, irc):
     if i.msg.is_channel_mode():
+        refetch = False
         for mode in i.msg.get_modes():
-            if mode["mode"] in irc.prefix:
-                _user_prefix_mode(i, irc, mode)
+            if mode["mode"] in irc.prefix and "param" in mode:
+                refetch |= _user_prefix_mode(i, irc, mode)
+        if refetch:
+            # At most one NAMES for all the modes of the message.
+            irc.out.names([i.msg.get_target()])
     else:
         # User modes are not handled yet.
         pass
 
 
 def _user_prefix_mode(i, irc, mode):
+    """Apply a prefix mode change to the roster. Returns True if the
+    roster can not be updated and the channel's NAMES must be fetched.
+    """
     user = mode["param"]
     target = i.msg.get_target()
     prefix = irc.prefix[mode["mode"]]
     if mode["flag"] == "+":
-        insert_prefix(irc, target, user, prefix)
-    elif mode["flag"] == "-":
-        # There is no way to reliably know the full prefix list without IRCv3.
-        # We send a NAMES command to get a new list.
-        irc.out.names([target])
-
-
-def insert_prefix(irc, channel, nickname, new_prefix):
-    for index, prefix in enumerate(irc.names[channel][nickname]):
-        if is_higher_prefix(new_prefix, prefix):
-            irc.names[channel][nickname].insert(index, new_prefix)
-            return
-    irc.names[channel][nickname].append(new_prefix)
-
-
-def is_higher_prefix(x, y):
-    "Is x a higher channel prefix than y?"
-    val = {"": 0, "+": 1, "%": 2, "@": 3, "&": 4, "~": 5}
-    return val[x] > val[y]
+        irc.names.add_mode(target, user, prefix)
+        return False
+
+    if mode["flag"] == "-":
+        # Without IRCv3 multi-prefix NAMES only shows the highest prefix
+        # of a user. Removing it may reveal a lower one that we do not
+        # know about, so a new list is needed. Removing any other prefix,
+        # or the lowest one (usually +v), can be done locally.
+        modes = irc.names.get_modes(target, user)
+        if modes is None:
+            return False  # Not in the roster, NAMES will add it.
+        hidden = modes[:1] == prefix and prefix != irc.names.prefixes[-1:]
+        irc.names.remove_mode(target, user, prefix)
+        return hidden and "multi-prefix" not in irc.ircv3_enabled
+    return False
 
 
 # ====================================================================
@@ -214,8 +251,13 @@ def is_higher_prefix(x, y):
 # ====================================================================
 
 dispatch = {
+    "001":  rpl_welcome_001,
+    "005":  rpl_isupport_005,
+    "352":  rpl_whoreply_352,
     "353":  rpl_namreply_353,
     "366":  rpl_endofnames_366,
+    "396":  rpl_hosthidden_396,
+    "CHGHOST": chghost,
     "JOIN": join,
     "PART": part,
     "KICK": kick,
@@ -24,11 +24,32 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 import json
+import string
+import threading
+
 from user_auth import user_auth
 
 
 class Module:
     bot_commands = ["ignore", "unignore", "ignored", "ignore_mode"]
+    # The settings of a user are a row of ignore_settings and the users
+    # they ignore are rows of ignored. Users without a row have the
+    # defaults. Nicknames are compared case insensitively.
+    migrations = [
+        """
+        CREATE TABLE IF NOT EXISTS ignore_settings (
+            user TEXT COLLATE NOCASE PRIMARY KEY,
+            registered_only INTEGER NOT NULL DEFAULT 0,
+            ignore_all INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS ignored (
+            user TEXT COLLATE NOCASE NOT NULL,
+            target TEXT COLLATE NOCASE NOT NULL,
+            PRIMARY KEY (user, target)
+        );
+        """,
+        lambda db: migrate_json(db)  # The old table of JSON strings
+    ]
     manual = {
         "desc": ("Manage your ignore lists. Ignored users will not be able"
                  " to use your nickname in the supported modules."),
@@ -50,28 +71,110 @@ class Module:
 logo = "\x02ignore\x0F"
 
 
+# ====================================================================
+# Database
+# ====================================================================
+
+def migrate_json(db):
+    """Move the data of the old ``ignore'' table, that kept the settings
+    of every user as a JSON string, to the new tables."""
+    dbc = db.cursor()
+    dbc.execute("SELECT name FROM sqlite_master"
+                " WHERE type = 'table' AND name = 'ignore';")
+    if not dbc.fetchone():
+        return
+    dbc.execute("SELECT user, settings FROM ignore;")
+    for user, settings in dbc.fetchall():
+        try:
+            o = json.loads(settings)
+        except (TypeError, ValueError):
+            continue
+        dbc.execute("INSERT OR IGNORE INTO ignore_settings VALUES (?, ?, ?);",
+                    (user, bool(o.get("registered_only")),
+                     bool(o.get("ignore_all"))))
+        dbc.executemany("INSERT OR IGNORE INTO ignored VALUES (?, ?);",
+                        [(user, t) for t in o.get("ignored", [])])
+    dbc.execute("DROP TABLE ignore;")
+    clear()  # Read from the old table while it migrated
+
+
+# Read-through cache of the settings:
+# {user_key: (registered_only, ignore_all, {target_key})}
+# Users without settings are cached too, since they are the most common.
+# The keys are made by nocase(), so that the cache compares nicknames
+# the way the COLLATE NOCASE columns do. It is created empty on every
+# (re)load of the module.
+_cache = {}
+_lock = threading.Lock()
+# Incremented by every invalidation. A read that started before one
+# does not store what it read, it may be older than the write.
+_generation = 0
+cache_size = 4096
+
+_nocase = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def nocase(nickname):
+    """Fold the case of ``nickname'' like SQLite's NOCASE collation,
+    which only folds the ASCII letters."""
+    return nickname.translate(_nocase)
+
+
+def get_settings(db, user):
+    key = nocase(user)
+    with _lock:
+        try:
+            return _cache[key]
+        except KeyError:
+            generation = _generation
+    dbc = db.cursor()
+    dbc.execute("SELECT registered_only, ignore_all FROM ignore_settings"
+                " WHERE user = ?;", (user,))
+    row = dbc.fetchone() or (False, False)
+    dbc.execute("SELECT target FROM ignored WHERE user = ?;", (user,))
+    targets = {nocase(t) for t, in dbc.fetchall()}
+    settings = (bool(row[0]), bool(row[1]), targets)
+    with _lock:
+        if generation == _generation:
+            if len(_cache) >= cache_size:
+                _cache.clear()
+            _cache[key] = settings
+    return settings
+
+
+def invalidate(user):
+    global _generation
+    with _lock:
+        _generation += 1
+        _cache.pop(nocase(user), None)
+
+
+def clear():
+    global _generation
+    with _lock:
+        _generation += 1
+        _cache.clear()
+
+
 # ====================================================================
 # Functions for use by other modules
 # ====================================================================
 
 def is_ignored(i, irc, user, query_nick):
-    dbc = i.db_disk.cursor()
     try:
-        dbc.execute("SELECT settings FROM ignore WHERE user = ?;", (user,))
-        j = dbc.fetchone()[0]
-        o = json.loads(j)
-
-        if o["ignore_all"]:
-            return True
-        elif o["registered_only"] and not user_auth(i, irc, query_nick):
-            return True
-        elif query_nick in o["ignored"]:
-            return True
-        else:
-            return False
+        registered_only, ignore_all, targets = get_settings(i.db_disk, user)
     except Exception:
         return False
 
+    if ignore_all:
+        return True
+    elif nocase(query_nick) in targets:
+        return True
+    elif registered_only and not user_auth(i, irc, query_nick):
+        return True
+    else:
+        return False
+
 
 # ====================================================================
 # Ignore
@@ -90,7 +193,7 @@ def ignore(i, irc, dbc):
         irc.out.notice(receiver, f"{logo}: You cannot ignore yourself.")
         return
 
-    if args.lower() == irc.curr_nickname.lower():
+    if irc.is_curr_nickname(args):
         irc.out.notice(receiver, f"{logo}: Ignoring the bot has no effect.")
         return
 
@@ -107,16 +210,9 @@ def ignore(i, irc, dbc):
 
 def ignore_database(dbc, user, to_ignore):
     try:
-        dbc.execute("SELECT settings FROM ignore WHERE user = ?;", (user,))
-        j = dbc.fetchone()[0]
-        o = json.loads(j)
-        if to_ignore not in o["ignored"]:
-            o["ignored"].append(ignore_nick)
-        else:
-            return 1
-        j = json.dumps(o)
-        dbc.execute("UPDATE ignore SET settings = ? WHERE user = ?;", (j, user))
-        return 0
+        dbc.execute("INSERT OR IGNORE INTO ignored VALUES (?, ?);",
+                    (user, to_ignore))
+        return 0 if dbc.rowcount == 1 else 1
     except Exception:
         return 2
 
@@ -145,13 +241,9 @@ def unignore(i, irc, dbc):
 
 def unignore_database(dbc, user, to_unignore):
     try:
-        dbc.execute("SELECT settings FROM ignore WHERE user = ?;", (user,))
-        j = dbc.fetchone()[0]
-        o = json.loads(j)
-        o["ignored"].remove(to_unignore)
-        j = json.dumps(o)
-        dbc.execute("UPDATE ignore SET settings = ? WHERE user = ?;", (j, user))
-        return 0
+        dbc.execute("DELETE FROM ignored WHERE user = ? AND target = ?;",
+                    (user, to_unignore))
+        return 0 if dbc.rowcount == 1 else 1
     except Exception:
         return 1
 
@@ -180,10 +272,12 @@ def ignored(i, irc, dbc):
 
 def ignored_database(dbc, user):
     try:
-        dbc.execute("SELECT settings FROM ignore WHERE user = ?;", (user,))
-        j = dbc.fetchone()[0]
-        o = json.loads(j)
-        return len(o["ignored"]), ", ".join(o["ignored"])
+        dbc.execute("SELECT target FROM ignored WHERE user = ?"
+                    " ORDER BY rowid;", (user,))
+        targets = [t for t, in dbc.fetchall()]
+        if not targets:
+            return False
+        return len(targets), ", ".join(targets)
     except Exception:
         return False
 
@@ -245,30 +339,24 @@ def ignore_mode(i, irc, dbc):
     irc.out.notice(receiver, m)
 
 
-def registered_only(dbc, user, value):
+def set_mode(dbc, user, mode, value):
+    # ``mode'' is a column name: registered_only or ignore_all
     try:
-        dbc.execute("SELECT settings FROM ignore WHERE user = ?;", (user,))
-        j = dbc.fetchone()[0]
-        o = json.loads(j)
-        o["registered_only"] = value
-        j = json.dumps(o)
-        dbc.execute("UPDATE ignore SET settings = ? WHERE user = ?;", (j, user))
+        dbc.execute("INSERT OR IGNORE INTO ignore_settings (user)"
+                    " VALUES (?);", (user,))
+        dbc.execute(f"UPDATE ignore_settings SET {mode} = ?"
+                    " WHERE user = ?;", (value, user))
         return 0
     except Exception:
         return 1
 
 
+def registered_only(dbc, user, value):
+    return set_mode(dbc, user, "registered_only", value)
+
+
 def ignore_all(dbc, user, value):
-    try:
-        dbc.execute("SELECT settings FROM ignore WHERE user = ?;", (user,))
-        j = dbc.fetchone()[0]
-        o = json.loads(j)
-        o["ignore_all"] = value
-        j = json.dumps(o)
-        dbc.execute("UPDATE ignore SET settings = ? WHERE user = ?;", (j, user))
-        return 0
-    except Exception:
-        return 1
+    return set_mode(dbc, user, "ignore_all", value)
 
 
 # ====================================================================
@@ -282,18 +370,11 @@ dispatch = {
     "ignore_mode": ignore_mode
 }
 
+
 def main(i, irc):
     dbc = i.db_disk.cursor()
-    nickname = i.msg.get_nickname()
-    dbc.execute("""
-CREATE TABLE IF NOT EXISTS ignore (
-    user TEXT COLLATE NOCASE PRIMARY KEY,
-    settings TEXT COLLATE NOCASE
-);
-""")
-    jdef = '{"ignored": [], "registered_only": false, "ignore_all": false}'
-    dbc.execute("INSERT OR IGNORE INTO ignore VALUES (?, ?);", (nickname, jdef))
 
     dispatch[i.msg.get_botcmd()](i, irc, dbc)
 
     i.db_disk.commit()
+    invalidate(i.msg.get_nickname())
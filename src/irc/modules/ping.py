@@ -23,11 +23,23 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
 class Module:
-    irc_commands = ["PING"]
+    irc_commands = ["PING", "PONG"]
 
 
-def main(i, irc):
+def ping(i, irc):
     if hasattr(i.msg, "server2"):
         irc.out.pong(i.msg.server1, i.msg.server2)
     else:
         irc.out.pong(i.msg.server1)
+
+
+def pong(i, irc):
+    # Replies to the keepalive PINGs (see irc/keepalive.py)
+    irc.keepalive.pong(i.msg.get_token())
+
+
+def main(i, irc):
+    {
+        "PING": ping,
+        "PONG": pong
+    }[i.msg.get_command()](i, irc)
@@ -19,6 +19,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 import base64
+import time
 
 import constants
 
@@ -26,6 +27,8 @@ import constants
 class Module:
     irc_commands = ["CAP", "AUTHENTICATE", "903", "904", "433", "376"]
     startup = True
+    startup_first = True  # Registers before the other startup modules
+    serial = True  # The CAP replies must apply in order
 
 
 def init(i, irc):
@@ -39,6 +42,13 @@ def init(i, irc):
 
     irc.curr_nickname = nickname
 
+    # Startup time, only for the first connection
+    start_time = i.bot.pop("start_time", None)
+    if start_time is not None:
+        elapsed = time.perf_counter() - start_time
+        i.bot["runlog"].info(f"- CAP LS sent {elapsed * 1000:.0f}ms after"
+                             " startup")
+
 
 def cap(i, irc):
     subcmd = i.msg.get_subcommand()
@@ -46,6 +56,8 @@ def cap(i, irc):
         cap_ls(subcmd, irc)
     elif str(subcmd) == "ACK":
         cap_ack(i, subcmd, irc)
+    elif str(subcmd) == "NAK":
+        cap_nak(i, subcmd, irc)
 
 
 def cap_ls(ls, irc):
@@ -58,11 +70,37 @@ def cap_ls(ls, irc):
         return
 
     req_s = " ".join(req)
+    irc.cap_pending = 1
     irc.send(('CAP', 'REQ', f':{req_s}'))
 
 
 def cap_ack(i, ack, irc):
-    irc.ircv3_enabled = ack.get_enabled()
+    for cap in ack.get_enabled():
+        if cap not in irc.ircv3_enabled:
+            irc.ircv3_enabled.append(cap)
+    cap_answered(i, irc)
+
+
+def cap_nak(i, nak, irc):
+    # A CAP REQ is accepted or refused whole. Request the capabilities of
+    # a refused set one by one, so that only those the server does not
+    # support are left out.
+    caps = nak.get_list()
+    if len(caps) > 1:
+        irc.cap_pending += len(caps)
+        for cap in caps:
+            irc.send(('CAP', 'REQ', f':{cap}'))
+    else:
+        i.bot["runlog"].info("- The server refused the capability:"
+                             f" {' '.join(caps)}")
+    cap_answered(i, irc)
+
+
+def cap_answered(i, irc):
+    """End the capability negotiation once every CAP REQ is answered."""
+    irc.cap_pending -= 1
+    if irc.cap_pending > 0:
+        return
 
     if i.bot["conf"].is_auth_method("sasl") and "sasl" in irc.ircv3_enabled:
         irc.send(('AUTHENTICATE', 'PLAIN'))
@@ -104,7 +142,19 @@ def rpl_endofmotd_376(i, irc):
     elif i.bot["conf"].is_auth_method("nickserv"):
         irc.out.privmsg("NickServ", f"IDENTIFY {nickname} {password}")
 
-    irc.out.join(i.bot["conf"].get_channels())
+    # Join the configured channels and those we were in before losing
+    # the connection.
+    channels = dict(i.bot["conf"].get_channels())
+    keys = {irc.casemapping(c) for c in channels}
+    for channel in i.bot.get("rejoin", []):
+        if irc.casemapping(channel) not in keys:
+            channels[channel] = ""
+    irc.out.join(channels)
+
+    # Learn our hostmask, if the server did not tell us yet, so that
+    # irc.send can fit as much text as possible in every line.
+    if not irc.bot_hostmask:
+        irc.send(("WHO", irc.curr_nickname))
 
 
 def main(i, irc):
@@ -38,7 +38,7 @@ def user_auth(i, irc, nickname, timeout=10):
         auth = i.varget(nickname)
         if auth != "_pending":
             return auth
-        if time.time() > to:
+        if time.time() > to or i.cancel.is_set():
             return False
 
 
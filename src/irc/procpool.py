@@ -0,0 +1,149 @@
+# coding=utf-8
+
+# Run the calls of CPU bound modules in worker processes, so that they
+# do not hold the GIL of the bot. The message and a copy of the state
+# the module may read are sent to the worker and what the module sends
+# to IRC is recorded there and sent by the bot when the call returns.
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import copy
+import importlib
+import multiprocessing
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import irc.modules
+from irc.casemap import Casemapping
+from irc.irc import Drastikbot
+
+
+def new_pool(workers):
+    # Forking a process with many threads can copy locks in a held
+    # state, so the workers are started from scratch.
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+# ====================================================================
+# Parent side: what is sent to the worker
+# ====================================================================
+
+class RecordedOutput:
+    """Stands in for irc.out in the worker. The calls are recorded as
+    (method, args, kwargs) to be made by replay()."""
+    def __init__(self, calls):
+        self._calls = calls
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self._calls.append((name, args, kwargs))
+        return record
+
+
+class IRCSlice:
+    """A picklable copy of the Drastikbot attributes a module can read.
+    The channel roster (irc.names) is not copied. irc.send and irc.out
+    are recorded."""
+    fields = (
+        "curr_nickname", "bot_hostmask", "bot_user", "bot_host",
+        "alt_nickname", "conn_state", "botmodes", "ircv3_enabled",
+        "channels", "isupport", "prefix", "chantypes", "chanmodes",
+        "nicklen", "channellen", "targmax", "maxtargets", "linelen",
+        "msg_len", "msg_delay"
+    )
+
+    def __init__(self, irc):
+        for field in self.fields:
+            setattr(self, field, copy.deepcopy(getattr(irc, field)))
+        # Without the cache of the bot's instance
+        self.casemapping = Casemapping(irc.casemapping.name)
+        self.calls = []  # Recorded in the worker
+        self.out = RecordedOutput(self.calls)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("out", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.out = RecordedOutput(self.calls)
+
+    def send(self, *args, **kwargs):
+        self.calls.append(("send", args, kwargs))
+
+    get_targmax = Drastikbot.get_targmax
+    is_curr_nickname = Drastikbot.is_curr_nickname
+
+
+def picklable_msg(msg, irc_slice):
+    """A copy of ``msg'' that uses ``irc_slice'' instead of the bot."""
+    msg = copy.copy(msg)
+    if hasattr(msg, "irc"):
+        msg.irc = irc_slice
+    msg.casemap = irc_slice.casemapping
+    return msg
+
+
+def replay(irc, calls):
+    """Make the irc.send and irc.out calls recorded in the worker."""
+    for name, args, kwargs in calls:
+        if name == "send":
+            irc.send(*args, **kwargs)
+        else:
+            getattr(irc.out, name)(*args, **kwargs)
+
+
+# ====================================================================
+# Worker side
+# ====================================================================
+
+_var_memory = None
+
+
+def run_module(module_name, msg, bot, irc_slice):
+    """Call the module's main() in the worker process. Returns the
+    recorded calls, the traceback if it raised or None and the CPU
+    time of the call."""
+    global _var_memory
+    if _var_memory is None:
+        _var_memory = irc.modules.VariableMemory()
+
+    data = irc.modules.CallbackData(
+        msg=msg,
+        db_memory=None,
+        db_disk=None,
+        bot=bot,
+        varget=_var_memory.varget,
+        varset=_var_memory.varset,
+        cancel=threading.Event(),
+        scheduler=None
+    )
+
+    cpu = time.process_time()
+    try:
+        module = importlib.import_module(module_name)
+        module.main(data, irc_slice)
+        tc = None
+    except Exception:
+        tc = traceback.format_exc()
+    return irc_slice.calls, tc, time.process_time() - cpu
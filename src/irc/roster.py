@@ -0,0 +1,284 @@
+# coding=utf-8
+
+# The channel roster: which users are in which channels and with what
+# channel prefixes (modes). It is kept up to date by the events module.
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+from collections.abc import Mapping
+
+from irc.casemap import Casemapping
+
+
+class Roster(Mapping):
+    """Channel membership of every user the bot can see.
+
+    Channels and nicknames are stored under casemapped keys (see
+    irc.casemap), so that ``#Chan'' and ``#chan'' are the same channel.
+    Besides the channel to members mapping, a reverse index of nickname
+    to channels is kept so that QUIT and NICK only touch the channels
+    the user is in.
+
+    A membership is stored as a (nickname, modes) tuple where modes is a
+    string of channel prefixes ordered from the highest to the lowest
+    (e.g. "@+"). The user and host of a nickname are kept once, for as
+    long as it shares a channel with the bot.
+
+    For compatibility the roster can be read like the old ``irc.names''
+    dictionary: roster[channel][nickname] returns the list of prefixes
+    of the user, or [""] if the user has none. That view is read only.
+    """
+
+    def __init__(self, casemap=None, prefixes="~&@%+"):
+        self.casemap = Casemapping() if casemap is None else casemap
+        self.prefixes = prefixes  # Highest to lowest
+        self._channels = {}  # {channel_key: (channel, {nick_key: member})}
+        self._nicks = {}  # {nick_key: {channel_key}}
+        self._hosts = {}  # {nick_key: (user, host)}
+        self._names_pending = set()  # {channel_key} NAMES in progress
+
+    # Mapping interface (read only compatibility view) ###############
+
+    def __getitem__(self, channel):
+        try:
+            return ChannelView(self, self._channels[self.casemap(channel)])
+        except KeyError:
+            raise KeyError(channel) from None
+
+    def __iter__(self):
+        # events is the only writer, but other modules read the roster
+        # from their own threads. list() copies the values without
+        # running Python code, so the copy cannot see the dictionary
+        # change size.
+        return iter([name for name, _ in list(self._channels.values())])
+
+    def __len__(self):
+        return len(self._channels)
+
+    def __contains__(self, channel):
+        return self.casemap(channel) in self._channels
+
+    # Queries ########################################################
+
+    def is_on(self, channel, nickname):
+        members = self._members(channel)
+        return members is not None and self.casemap(nickname) in members
+
+    def get_modes(self, channel, nickname):
+        """Get the prefixes of a user in a channel as a string. If the
+        user is not in the channel None is returned."""
+        members = self._members(channel)
+        if members is None:
+            return None
+        member = members.get(self.casemap(nickname))
+        return None if member is None else member[1]
+
+    def get_nicknames(self, channel):
+        members = self._members(channel)
+        if members is None:
+            return []
+        return [nickname for nickname, _ in list(members.values())]
+
+    def get_hostmask(self, nickname):
+        """Get "nickname!user@host" if the user and host are known, or
+        None otherwise."""
+        nick_key = self.casemap(nickname)
+        if nick_key not in self._hosts:
+            return None
+        user, host = self._hosts[nick_key]
+        return f"{nickname}!{user}@{host}"
+
+    def get_channels(self, nickname):
+        """Get the channels that both the bot and the user are in."""
+        keys = list(self._nicks.get(self.casemap(nickname), ()))
+        entries = [self._channels.get(key) for key in keys]
+        return [entry[0] for entry in entries if entry is not None]
+
+    # Updates ########################################################
+
+    def add_channel(self, channel):
+        key = self.casemap(channel)
+        if key not in self._channels:
+            self._channels[key] = (channel, {})
+
+    def remove_channel(self, channel):
+        key = self.casemap(channel)
+        entry = self._channels.pop(key, None)
+        self._names_pending.discard(key)
+        if entry is None:
+            return
+        for nick_key in entry[1]:
+            self._unindex(nick_key, key)
+
+    def join(self, channel, nickname, modes="", user=None, host=None):
+        self.add_channel(channel)
+        key = self.casemap(channel)
+        nick_key = self.casemap(nickname)
+        self._channels[key][1][nick_key] = (nickname, self._order(modes))
+        self._nicks.setdefault(nick_key, set()).add(key)
+        if user and host:
+            self._hosts[nick_key] = (user, host)
+
+    def set_host(self, nickname, user, host):
+        """Update the user and host of a nickname (e.g. on CHGHOST)."""
+        nick_key = self.casemap(nickname)
+        if nick_key in self._nicks:
+            self._hosts[nick_key] = (user, host)
+
+    def part(self, channel, nickname):
+        key = self.casemap(channel)
+        nick_key = self.casemap(nickname)
+        members = self._members(channel)
+        if members is None or members.pop(nick_key, None) is None:
+            return
+        self._unindex(nick_key, key)
+
+    def quit(self, nickname):
+        """Remove a user from every channel. Returns the channels the
+        user was in."""
+        nick_key = self.casemap(nickname)
+        keys = self._nicks.pop(nick_key, ())
+        self._hosts.pop(nick_key, None)
+        channels = []
+        for key in keys:
+            channel, members = self._channels[key]
+            members.pop(nick_key, None)
+            channels.append(channel)
+        return channels
+
+    def rename(self, old_nickname, new_nickname):
+        """Change a user's nickname in every channel. Returns the
+        channels the user is in."""
+        old_key = self.casemap(old_nickname)
+        new_key = self.casemap(new_nickname)
+        keys = self._nicks.pop(old_key, set())
+        channels = []
+        for key in keys:
+            channel, members = self._channels[key]
+            _, modes = members.pop(old_key)
+            members[new_key] = (new_nickname, modes)
+            channels.append(channel)
+        if keys:
+            self._nicks.setdefault(new_key, set()).update(keys)
+        if old_key in self._hosts:
+            self._hosts[new_key] = self._hosts.pop(old_key)
+        return channels
+
+    def add_mode(self, channel, nickname, prefix):
+        self._set_modes(channel, nickname, lambda m: m + prefix)
+
+    def remove_mode(self, channel, nickname, prefix):
+        self._set_modes(channel, nickname, lambda m: m.replace(prefix, ""))
+
+    def names_reply(self, channel, names, hosts=None):
+        """Apply an RPL_NAMREPLY (353). The first reply after the end of
+        a previous NAMES list replaces the channel's members.
+
+        :param names: {nickname: modes} where modes is a string or a
+                      list of prefixes.
+        :param hosts: {nickname: (user, host)} when the server sends
+                      hostmasks (IRCv3 userhost-in-names).
+        """
+        key = self.casemap(channel)
+        if key not in self._names_pending:
+            self.remove_channel(channel)
+            self.add_channel(channel)
+            self._names_pending.add(key)
+        hosts = hosts or {}
+        for nickname, modes in names.items():
+            self.join(channel, nickname, "".join(modes),
+                      *hosts.get(nickname, (None, None)))
+
+    def names_end(self, channel):
+        """Apply an RPL_ENDOFNAMES (366)."""
+        self._names_pending.discard(self.casemap(channel))
+
+    def rekey(self):
+        """Recompute every key. Call it after the casemapping changes."""
+        channels = list(self._channels.values())
+        pending = [self._channels[k][0] for k in self._names_pending
+                   if k in self._channels]
+        hosts = self._hosts
+        self._channels = {}
+        self._nicks = {}
+        self._hosts = {}
+        self._names_pending = set()
+        for channel, members in channels:
+            self.add_channel(channel)
+            for nick_key, (nickname, modes) in members.items():
+                self.join(channel, nickname, modes,
+                          *hosts.get(nick_key, (None, None)))
+        for channel in pending:
+            self._names_pending.add(self.casemap(channel))
+
+    # Helpers ########################################################
+
+    def _members(self, channel):
+        entry = self._channels.get(self.casemap(channel))
+        return None if entry is None else entry[1]
+
+    def _unindex(self, nick_key, channel_key):
+        keys = self._nicks.get(nick_key)
+        if keys is None:
+            return
+        keys.discard(channel_key)
+        if not keys:
+            del self._nicks[nick_key]
+            self._hosts.pop(nick_key, None)
+
+    def _order(self, modes):
+        if len(modes) < 2:
+            return modes
+        return "".join(p for p in self.prefixes if p in modes)
+
+    def _set_modes(self, channel, nickname, fn):
+        members = self._members(channel)
+        if members is None:
+            return
+        nick_key = self.casemap(nickname)
+        member = members.get(nick_key)
+        if member is None:
+            return  # Not in the list yet. NAMES will bring it up to date.
+        members[nick_key] = (member[0], self._order(fn(member[1])))
+
+
+class ChannelView(Mapping):
+    """Read only {nickname: [prefixes]} view of a channel's members."""
+
+    def __init__(self, roster, entry):
+        self.roster = roster
+        self.channel, self.members = entry
+
+    def __getitem__(self, nickname):
+        try:
+            modes = self.members[self.roster.casemap(nickname)][1]
+        except KeyError:
+            raise KeyError(nickname) from None
+        return list(modes) or [""]
+
+    def __iter__(self):
+        # A snapshot, see Roster.__iter__()
+        return iter([nickname for nickname, _ in
+                     list(self.members.values())])
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, nickname):
+        return self.roster.casemap(nickname) in self.members
@@ -0,0 +1,373 @@
+# coding=utf-8
+
+# Timers shared by the bot and its modules. One thread keeps the jobs in
+# a heap ordered by their next run and hands the due ones to a small
+# thread pool, so periodic modules do not need a sleeping thread each.
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import datetime
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ====================================================================
+# Cron expressions
+# ====================================================================
+
+class Cron:
+    """A cron expression: "minute hour day_of_month month day_of_week".
+
+    Every field is ``*'', a number, a range ``a-b'' or a list of those
+    separated by commas, and any of them may end with a step ``/n''.
+    Days of the week are 0-6 starting on Sunday (7 is Sunday too). As in
+    cron, if both the day of the month and the day of the week are
+    restricted, a day that matches either of them matches.
+    """
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"A cron expression has 5 fields: '{spec}'")
+        self.spec = spec
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse(f, lo, hi) for f, (lo, hi) in zip(fields, self.ranges)
+        ]
+        self.weekdays = {d % 7 for d in self.weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def __str__(self):
+        return self.spec
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        ret = set()
+        for part in field.split(","):
+            part, _, step = part.partition("/")
+            step = int(step) if step else 1
+            if part == "*":
+                start, end = lo, hi
+            elif "-" in part:
+                start, end = (int(x) for x in part.split("-", 1))
+            else:
+                start = end = int(part)
+                if step > 1:
+                    end = hi  # "5/15" is "5-59/15"
+            if not lo <= start <= end <= hi or step < 1:
+                raise ValueError(f"Invalid cron field: '{field}'")
+            ret.update(range(start, end + 1, step))
+        return ret
+
+    def _day_matches(self, d):
+        if d.month not in self.months:
+            return False
+        day = d.day in self.days
+        weekday = (d.isoweekday() % 7) in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next(self, after):
+        """The first datetime after ``after'' that matches."""
+        t = after.replace(second=0, microsecond=0)
+        t += datetime.timedelta(minutes=1)
+        for _ in range(366 * 8):  # Enough for Feb 29 on a given weekday
+            if self._day_matches(t):
+                for hour in sorted(h for h in self.hours if h >= t.hour):
+                    start = t.minute if hour == t.hour else 0
+                    minutes = [m for m in self.minutes if m >= start]
+                    if minutes:
+                        return t.replace(hour=hour, minute=min(minutes))
+            t = (t + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+        raise ValueError(f"The cron expression never matches: '{self}'")
+
+
+# ====================================================================
+# Jobs
+# ====================================================================
+
+class Job:
+    """A scheduled call. Returned by the Scheduler methods that add jobs
+    and kept by the scheduler until it is cancelled or, for one-shot
+    jobs, until it runs.
+    """
+    def __init__(self, scheduler, name, fn, args, kwargs, interval=None,
+                 cron=None, connected=True):
+        self.scheduler = scheduler
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.interval = interval  # Seconds, for every()
+        self.cron = cron  # Cron, for cron()
+        self.connected = connected  # Only run while connected
+        self.due = 0.0  # time.monotonic() of the next run
+        self.cancelled = False
+        self.running = False
+
+        # Metrics
+        self.runs = 0
+        self.errors = 0
+        self.skipped = 0  # Runs skipped, the previous one was running
+        self.held = 0  # Runs held back while disconnected
+        self.last_run = None  # time.time() of the last run
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.max_delay = 0.0  # Longest time a run started after its due
+
+    def __repr__(self):
+        return f"<Job '{self.name}'>"
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+    def next_due(self, now):
+        """The time.monotonic() of the run after the one due at ``due''.
+        None for one-shot jobs."""
+        if self.interval is not None:
+            # Keep the rate, but do not try to catch up on missed runs.
+            due = self.due + self.interval
+            return due if due > now else now + self.interval
+        if self.cron is not None:
+            at = self.cron.next(datetime.datetime.now())
+            return now + (at - datetime.datetime.now()).total_seconds()
+        return None
+
+    def to_dict(self):
+        return {
+            "schedule": (f"every {self.interval}s" if self.interval
+                         is not None else str(self.cron or "once")),
+            "connected": self.connected,
+            "runs": self.runs,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "held": self.held,
+            "last_run": self.last_run,
+            "last_duration": self.last_duration,
+            "max_duration": self.max_duration,
+            "avg_duration": (self.total_duration / self.runs
+                             if self.runs else None),
+            "max_delay": self.max_delay
+        }
+
+
+# ====================================================================
+# Scheduler
+# ====================================================================
+
+class Scheduler:
+    """Run jobs at a point in time, at an interval or on a cron schedule.
+
+    The jobs are called with ``*args'' and ``**kwargs'' in a pool of
+    ``workers'' threads, so a slow job only delays other jobs when every
+    worker is busy. A job never runs twice at the same time: if a run is
+    due while the previous one has not returned, it is skipped.
+
+    Jobs added with ``connected=True'' (the default) only run while the
+    bot is registered to the server. The worker calls pause() when the
+    connection is lost and resume() when the next one is registered.
+    The runs that were due in between are held back and happen once, on
+    resume(). Jobs with ``connected=False'' always run.
+
+    Adding a job with the name of an existing job replaces it, so that a
+    startup module can add its jobs on every connection. Without a name
+    the job is named after the function, with a number appended if that
+    name is taken, and never replaces another job.
+    """
+    def __init__(self, log=None, workers=4):
+        self.log = log
+        self.lock = threading.Condition()
+        self.heap = []  # [(due, seq, job)]
+        self.jobs = {}  # {name: Job}
+        self.held = []  # [Job] held back while paused
+        self.paused = True  # Not connected yet
+        self.stopped = False
+        self.seq = itertools.count()  # Keeps the heap order stable
+        self.pool = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix="scheduler")
+        self.thread = threading.Thread(target=self._run, name="scheduler",
+                                       daemon=True)
+        self.thread.start()
+
+    # Adding jobs ####################################################
+
+    def once(self, delay, fn, *args, name=None, connected=True, **kwargs):
+        """Call fn once, ``delay'' seconds from now."""
+        job = Job(self, name, fn, args, kwargs, connected=connected)
+        return self._add(job, time.monotonic() + delay)
+
+    def every(self, interval, fn, *args, name=None, connected=True,
+              first=None, **kwargs):
+        """Call fn every ``interval'' seconds. The first call is made
+        ``first'' seconds from now, by default after one interval."""
+        if interval <= 0:
+            raise ValueError("The interval must be positive")
+        job = Job(self, name, fn, args, kwargs, interval=interval,
+                  connected=connected)
+        first = interval if first is None else first
+        return self._add(job, time.monotonic() + first)
+
+    def cron(self, spec, fn, *args, name=None, connected=True, **kwargs):
+        """Call fn on the times that match the cron expression ``spec''
+        in local time, e.g. "0 9 * * 1-5" for 9:00 on weekdays."""
+        job = Job(self, name, fn, args, kwargs, cron=Cron(spec),
+                  connected=connected)
+        return self._add(job, job.next_due(time.monotonic()))
+
+    def _add(self, job, due):
+        with self.lock:
+            if job.name is None:
+                module = getattr(job.fn, "__module__", None)
+                base = f"{module}.{getattr(job.fn, '__qualname__', '?')}"
+                job.name = base
+                for n in itertools.count(2):
+                    if job.name not in self.jobs:
+                        break
+                    job.name = f"{base}-{n}"
+            old = self.jobs.get(job.name)
+            if old is not None:
+                self._cancel(old)
+            job.due = due
+            self.jobs[job.name] = job
+            heapq.heappush(self.heap, (due, next(self.seq), job))
+            self.lock.notify()
+        return job
+
+    def cancel(self, job):
+        with self.lock:
+            self._cancel(job)
+
+    def _cancel(self, job):
+        # The job is left in the heap and skipped when it comes up.
+        job.cancelled = True
+        if self.jobs.get(job.name) is job:
+            del self.jobs[job.name]
+        if job in self.held:
+            self.held.remove(job)
+
+    def get(self, name):
+        with self.lock:
+            return self.jobs.get(name)
+
+    # Connection state ###############################################
+
+    def pause(self):
+        """Hold back the jobs that need a connection."""
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        """Run the jobs held back by pause() and let them run again."""
+        with self.lock:
+            self.paused = False
+            held, self.held = self.held, []
+            for job in held:
+                self._start(job, time.monotonic())
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.lock.notify()
+        self.pool.shutdown(wait=False)
+
+    # Scheduling #####################################################
+
+    def _run(self):
+        with self.lock:
+            while not self.stopped:
+                now = time.monotonic()
+                if not self.heap:
+                    self.lock.wait()
+                    continue
+                due, _, job = self.heap[0]
+                if due > now:
+                    self.lock.wait(due - now)
+                    continue
+
+                heapq.heappop(self.heap)
+                if job.cancelled:
+                    continue
+
+                if job.connected and self.paused:
+                    if job not in self.held:
+                        self.held.append(job)
+                    job.held += 1
+                else:
+                    self._start(job, now)
+
+                next_due = job.next_due(now)
+                if next_due is None:
+                    if job not in self.held:
+                        self._forget(job)
+                    continue
+                job.due = next_due
+                heapq.heappush(self.heap, (next_due, next(self.seq), job))
+
+    def _forget(self, job):
+        if self.jobs.get(job.name) is job:
+            del self.jobs[job.name]
+
+    def _start(self, job, now):
+        # Called with the lock held.
+        if job.running:
+            job.skipped += 1
+            return
+        job.running = True
+        job.max_delay = max(job.max_delay, now - job.due)
+        try:
+            self.pool.submit(self._call, job)
+        except RuntimeError:
+            job.running = False  # Shut down
+
+    def _call(self, job):
+        start = time.perf_counter()
+        error = False
+        try:
+            job.fn(*job.args, **job.kwargs)
+        except Exception:
+            error = True
+            if self.log:
+                tc = traceback.format_exc()
+                self.log.debug(f"- Scheduled job ``{job.name}'' error:"
+                               f"\n{tc}")
+        duration = time.perf_counter() - start
+
+        with self.lock:
+            job.running = False
+            job.runs += 1
+            job.errors += error
+            job.last_run = time.time()
+            job.last_duration = duration
+            job.max_duration = max(job.max_duration, duration)
+            job.total_duration += duration
+            if job.interval is None and job.cron is None:
+                self._forget(job)  # A one-shot job that was held back
+
+    # Metrics ########################################################
+
+    def to_dict(self):
+        with self.lock:
+            return {name: job.to_dict() for name, job in self.jobs.items()}
@@ -0,0 +1,99 @@
+# coding=utf-8
+
+# The IRC servers the bot can connect to and the reconnection policy.
+# The list outlives the connections, so that the health of every server
+# and the backoff are kept across reconnects.
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import random
+import threading
+import time
+
+
+class Server:
+    def __init__(self, host, port, ssl=False, password=""):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.password = password
+
+        self.failures = 0  # Consecutive failed connections
+        self.last_failure = 0.0
+        self.last_success = 0.0
+
+    def __str__(self):
+        return f"{self.host}:{'+' if self.ssl else ''}{self.port}"
+
+
+class ServerList:
+    """Choose the server to connect to and how long to wait for it.
+
+    A server is healthy until a connection to it fails. The healthiest
+    server is always tried first: the one with the fewest consecutive
+    failures, and among those the one that failed least recently. With a
+    single server that is simply a retry, with more they take turns.
+
+    The first retry after losing a working connection is immediate and
+    the next ones back off exponentially with jitter, so that a server
+    restart costs seconds while a long outage does not flood the network
+    (nor do many bots reconnect in lockstep).
+    """
+    first_delay = 2    # Max delay of the first retry that has one
+    base_delay = 5     # Exponential backoff after that...
+    max_delay = 300    # ...up to 5 minutes
+
+    def __init__(self, servers):
+        """:param servers: [{"host": ..., "port": ..., "ssl": ...,
+                              "password": ...}] in order of preference.
+        """
+        self.servers = [Server(**s) for s in servers]
+        self.attempts = 0  # Failed attempts since the last success
+        self.lock = threading.Lock()
+
+    def pick(self):
+        with self.lock:
+            return min(self.servers,
+                       key=lambda s: (s.failures, s.last_failure))
+
+    def delay(self, server):
+        """Seconds to wait before connecting to ``server''."""
+        with self.lock:
+            if self.attempts == 0:
+                return 0
+            if server.failures == 0 or self.attempts == 1:
+                # A retry, or a server we did not try yet.
+                return random.uniform(0, self.first_delay)
+            d = self.base_delay * 2 ** (server.failures - 1)
+            d = min(self.max_delay, d)
+            return random.uniform(d / 2, d)
+
+    def failure(self, server):
+        """Connecting or registering to ``server'' failed."""
+        with self.lock:
+            server.failures += 1
+            server.last_failure = time.time()
+            self.attempts += 1
+
+    def success(self, server):
+        """Registered to ``server''. Resets the backoff."""
+        with self.lock:
+            server.failures = 0
+            server.last_success = time.time()
+            self.attempts = 0
@@ -31,6 +31,8 @@ from concurrent.futures import ThreadPoolExecutor
 import irc.message
 import irc.modules
 from irc.irc import Drastikbot
+from irc.scheduler import Scheduler
+from irc.servers import ServerList
 
 
 irc_client = None
@@ -43,30 +45,44 @@ def run(state0):
     global state, irc_client
     state = state0
 
+    # Kept across reconnects
+    state["scheduler"] = Scheduler(state["runlog"])
     irc.modules.init(state)
+    state["modules"] = irc.modules.mod_import(state)
+    state["servers"] = ServerList(state["conf"].get_servers())
+    state["rejoin"] = []  # Channels to join again after reconnecting
 
     while True:
         if sigint:
+            irc.modules.shutdown(state)
             return
 
-        state["modules"] = irc.modules.mod_import(state)
-
         irc_client = Drastikbot(state)
         irc_client.connect()
+        irc_client.keepalive.start(state["scheduler"])
 
         signal.signal(signal.SIGINT, sigint_handler)
 
         irc_client.conn_state = 1
 
         with ThreadPoolExecutor() as tpool:
-            loop = tpool.submit(receive, tpool)
+            loop = tpool.submit(receive)
             tpool.submit(irc.modules.startup, state, irc_client)
 
             # Wait for the receive loop to return
             loop.result()
 
+        irc_client.keepalive.stop()
+        state["scheduler"].pause()  # Resumed once registered
+        irc.modules.stop_startup()
+
+        if irc_client.conn_state == 1:
+            # Lost before registering: count it against the server.
+            state["servers"].failure(irc_client.server)
+        state["rejoin"] = list(irc_client.channels)
+
 
-def receive(tpool):
+def receive():
     log = state["runlog"]
 
     data = b""
@@ -100,7 +116,8 @@ def receive(tpool):
             if state["devmode"]:
                 state["modules"] = irc.modules.reload_all(state)
 
-            tpool.submit(irc.modules.dispatch, state, irc_client, message)
+            # Dispatch in the receive loop to keep the message order.
+            irc.modules.dispatch(state, irc_client, message)
 
 
 def connection_lost():
@@ -111,9 +128,7 @@ def connection_lost():
     if sigint:
         return
 
-    log.info("! Connection lost. Retrying in"
-             f" {irc_client.reconnect_delay} seconds.")
-    log.info('! Reconnecting.')
+    log.info('! Connection lost. Reconnecting.')
 
 
 def sigint_handler(signum, frame):
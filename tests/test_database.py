@@ -0,0 +1,87 @@
+# coding=utf-8
+
+# Tests for irc.database
+#
+# Usage: python3 -m unittest discover tests
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import sqlite3
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from irc.database import (  # noqa: E402
+    DiskDatabase, MemoryDatabase, ModuleDatabase
+)
+
+
+class ModuleDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dbs = [MemoryDatabase(),
+                    DiskDatabase(str(Path(self.tmp.name, "test.db")))]
+
+    def tearDown(self):
+        for db in self.dbs:
+            db.close()
+        self.tmp.cleanup()
+
+    def test_close_keeps_the_database_open(self):
+        for db in self.dbs:
+            i = ModuleDatabase(db)
+            i.execute("CREATE TABLE t (a INTEGER);")
+            i.execute("INSERT INTO t VALUES (1);")
+            i.commit()
+            i.close()  # What a module may do at the end of its call
+
+            # The next call still works, it would block if it was closed
+            future = db.submit(lambda conn: conn.execute(
+                "SELECT a FROM t;").fetchall())
+            self.assertEqual(future.result(timeout=5), [(1,)])
+            dbc = ModuleDatabase(db).cursor()
+            dbc.execute("SELECT count(*) FROM t;")
+            self.assertEqual(dbc.fetchone(), (1,))
+
+    def test_cursor_connection_is_the_handle(self):
+        i = ModuleDatabase(self.dbs[0])
+        self.assertIs(i.cursor().connection, i)
+
+    def test_rollback_raises(self):
+        for db in self.dbs:
+            i = ModuleDatabase(db)
+            i.execute("CREATE TABLE t (a INTEGER);")
+            i.execute("INSERT INTO t VALUES (1);")
+            with self.assertRaises(sqlite3.NotSupportedError):
+                i.rollback()
+
+    def test_batch_is_all_or_nothing(self):
+        i = ModuleDatabase(self.dbs[1])
+        i.execute("CREATE TABLE t (a INTEGER UNIQUE);")
+        with self.assertRaises(sqlite3.IntegrityError):
+            i.batch([("INSERT INTO t VALUES (?);", (1,)),
+                     ("INSERT INTO t VALUES (?);", (1,))])
+        self.assertEqual(i.execute("SELECT a FROM t;").fetchall(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
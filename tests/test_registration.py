@@ -0,0 +1,106 @@
+# coding=utf-8
+
+# Tests for the capability negotiation of the registration module
+#
+# Usage: python3 -m unittest discover tests
+
+'''
+Copyright (C) 2023 drastik.org
+
+This file is part of drastikbot.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, version 3 only.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import sys
+import types
+import unittest
+from pathlib import Path
+
+src = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(src))
+sys.path.insert(0, str(src / "irc" / "modules"))
+
+import registration  # noqa: E402
+from irc.casemap import Casemapping  # noqa: E402
+from irc.message import parse  # noqa: E402
+
+
+class Conf:
+    def __init__(self, auth_method):
+        self.auth_method = auth_method
+
+    def is_auth_method(self, method):
+        return self.auth_method == method
+
+
+class Log:
+    def info(self, msg):
+        pass
+
+
+class IRC:
+    def __init__(self):
+        self.casemapping = Casemapping()
+        self.ircv3_enabled = []
+        self.cap_pending = 0
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+
+class CapTest(unittest.TestCase):
+    def setUp(self):
+        self.irc = IRC()
+
+    def receive(self, line, auth_method="sasl"):
+        self.irc.sent.clear()
+        i = types.SimpleNamespace(
+            msg=parse(self.irc, line.encode()),
+            bot={"conf": Conf(auth_method), "runlog": Log()})
+        registration.main(i, self.irc)
+        return self.irc.sent[:]
+
+    def test_ack(self):
+        self.receive(":srv CAP * LS :sasl multi-prefix")
+        sent = self.receive(":srv CAP * ACK :sasl multi-prefix")
+        self.assertEqual(sent, [("AUTHENTICATE", "PLAIN")])
+        self.assertEqual(self.irc.ircv3_enabled, ["sasl", "multi-prefix"])
+
+    def test_nak_requests_one_by_one(self):
+        sent = self.receive(":srv CAP * LS :sasl chghost multi-prefix")
+        self.assertEqual(sent, [("CAP", "REQ", ":sasl chghost multi-prefix")])
+
+        sent = self.receive(":srv CAP * NAK :sasl chghost multi-prefix")
+        self.assertEqual(sent, [("CAP", "REQ", ":sasl"),
+                                ("CAP", "REQ", ":chghost"),
+                                ("CAP", "REQ", ":multi-prefix")])
+
+        self.assertEqual(self.receive(":srv CAP * ACK :sasl"), [])
+        self.assertEqual(self.receive(":srv CAP * NAK :chghost"), [])
+        sent = self.receive(":srv CAP * ACK :multi-prefix")
+        self.assertEqual(sent, [("AUTHENTICATE", "PLAIN")])
+        self.assertEqual(self.irc.ircv3_enabled, ["sasl", "multi-prefix"])
+
+    def test_nak_of_everything_ends_the_negotiation(self):
+        self.receive(":srv CAP * LS :sasl chghost", auth_method="nickserv")
+        self.receive(":srv CAP * NAK :sasl chghost", auth_method="nickserv")
+        self.receive(":srv CAP * NAK :sasl", auth_method="nickserv")
+        sent = self.receive(":srv CAP * NAK :chghost", auth_method="nickserv")
+        self.assertEqual(sent, [("CAP", "END")])
+        self.assertEqual(self.irc.ircv3_enabled, [])
+
+
+if __name__ == "__main__":
+    unittest.main()